@@ -0,0 +1,195 @@
+'''
+Checkpoint writer of train.main.
+
+save() copies the state to the cpu and returns , the file is written by a background thread while training goes on.
+A checkpoint saved under several names ( last.pth , best_{metric}.pth , _{epoch}.pth ) is written once and the
+other names are hard links to it. Every name is replaced atomically : the file is written under a temporary name and
+renamed , an interrupted write never leaves a truncated checkpoint behind.
+Every written checkpoint is recorded in the Catalog of the directory , which the loaders query instead of probing
+file names.
+'''
+
+import os
+import shutil
+import threading
+import queue
+import json
+import hashlib
+import torch
+from time import time
+
+def to_cpu( state ):
+    '''deep copy of a ( nested dict/list of ) state , tensors copied to the cpu'''
+    if isinstance( state , torch.Tensor ):
+        state = state.detach()
+        return state.cpu() if state.is_cuda else state.clone()
+    if isinstance( state , dict ):
+        return type( state )( ( k , to_cpu( v ) ) for k , v in state.items() )
+    if isinstance( state , ( list , tuple ) ):
+        return type( state )( to_cpu( v ) for v in state )
+    return state
+
+def file_sha1( fname ):
+    h = hashlib.sha1()
+    with open( fname , 'rb' ) as f:
+        for chunk in iter( lambda : f.read( 2**20 ) , b'' ):
+            h.update( chunk )
+    return h.hexdigest()
+
+class Catalog():
+    '''
+    catalog.json of a checkpoint directory , one entry per file name:
+        epoch , metrics ( dict of the validation metrics of that epoch ) , sha1 , size , content , time
+    content is 'full' for the training checkpoints ( model , optimizer , scaler , lr schedule ) , 'model' or
+    'optimizer' for the state dicts of utils.save_model/save_optimizer. Several names with the same sha1 are the
+    same checkpoint.
+    The file is rewritten atomically on every change , readers never see a partial catalog.
+    '''
+    fname = 'catalog.json'
+
+    def __init__( self , dirname ):
+        self.dirname = dirname
+        self.reload()
+
+    def reload( self ):
+        fname = os.path.join( self.dirname , self.fname )
+        self.data = { 'run' : None , 'checkpoints' : {} }
+        if os.path.exists( fname ):
+            with open( fname ) as f:
+                self.data = json.load( f )
+        return self
+
+    def dump( self ):
+        fname = os.path.join( self.dirname , self.fname )
+        with open( fname + '.tmp' , 'w' ) as f:
+            json.dump( self.data , f , indent = 1 , sort_keys = True )
+        os.replace( fname + '.tmp' , fname )
+
+    @property
+    def run( self ):
+        return self.data['run']
+
+    def record( self , names , epoch , metrics = {} , content = 'full' , sha1 = None , size = None ):
+        '''adds ( or replaces ) the entries of a checkpoint written under names'''
+        if sha1 is None or size is None:
+            fname = os.path.join( self.dirname , names[0] )
+            sha1 , size = file_sha1( fname ) , os.path.getsize( fname )
+        for name in names:
+            self.data['checkpoints'][name] = { 'epoch' : epoch , 'metrics' : dict( metrics ) , 'sha1' : sha1 , 'size' : size , 'content' : content , 'time' : time() }
+        self.dump()
+
+    def remove( self , name ):
+        if self.data['checkpoints'].pop( name , None ) is not None:
+            self.dump()
+
+    def path( self , name ):
+        return os.path.join( self.dirname , name )
+
+    def entries( self , prefix = None , content = None ):
+        '''list of ( name , entry ) , optionally only the names starting with prefix and the given content'''
+        return [ ( name , entry ) for name , entry in self.data['checkpoints'].items()
+                 if ( prefix is None or name.startswith( prefix ) ) and ( content is None or entry['content'] == content ) ]
+
+    def latest( self , prefix = None , content = None ):
+        '''name of the checkpoint of the last epoch , None if there is none'''
+        entries = self.entries( prefix , content )
+        if len( entries ) == 0:
+            return None
+        return max( entries , key = lambda x : ( x[1]['epoch'] , x[1]['time'] ) )[0]
+
+    def top_k( self , metric , k , maximize = True , prefix = None , content = None ):
+        '''names of the k distinct checkpoints with the best value of metric , best first'''
+        entries = [ x for x in self.entries( prefix , content ) if metric in x[1]['metrics'] ]
+        entries.sort( key = lambda x : ( x[1]['metrics'][metric] if maximize else -x[1]['metrics'][metric] , x[1]['epoch'] ) , reverse = True )
+        names , seen = [] , set()
+        for name , entry in entries:
+            if entry['sha1'] not in seen:
+                seen.add( entry['sha1'] )
+                names.append( name )
+        return names[:k]
+
+    def best( self , metric , maximize = True , prefix = None , content = None ):
+        names = self.top_k( metric , 1 , maximize , prefix , content )
+        return names[0] if len( names ) else None
+
+class CheckpointManager():
+    '''
+    ARGUMENTS:
+    dirname: directory of the checkpoints , their catalog is dirname/catalog.json
+    log_fn: called with a message once a checkpoint is written , None for silence
+    run: name of the run kept in the catalog
+    '''
+    def __init__( self , dirname , log_fn = print , run = None ):
+        self.dirname = dirname
+        self.log_fn = log_fn
+        os.makedirs( dirname , exist_ok = True )
+        self.catalog = Catalog( dirname )
+        if run is not None:
+            self.catalog.data['run'] = run
+            self.catalog.dump()
+        #one checkpoint waits while the previous one is written , save() blocks beyond that
+        self.queue = queue.Queue( 1 )
+        self.error = None
+        self.thread = threading.Thread( target = self._write_loop , daemon = True )
+        self.thread.start()
+
+    def save( self , state , names , metrics = {} ):
+        '''
+        state: dict to torch.save , snapshotted before returning
+        names: file names ( relative to dirname ) of this checkpoint
+        metrics: metrics of this checkpoint for the catalog
+        '''
+        self._raise()
+        if len( names ) == 0:
+            return
+        self.queue.put( ( to_cpu( state ) , list( names ) , dict( metrics ) ) )
+
+    def _write( self , state , names , metrics ):
+        t = time()
+        paths = [ os.path.join( self.dirname , name ) for name in names ]
+        tmp = paths[0] + '.tmp'
+        torch.save( state , tmp )
+        sha1 , size = file_sha1( tmp ) , os.path.getsize( tmp )
+        for path in paths[1:]:
+            if os.path.exists( path + '.tmp' ):
+                os.remove( path + '.tmp' )
+            try:
+                os.link( tmp , path + '.tmp' )
+            except OSError:
+                #no hard links on this filesystem
+                shutil.copyfile( tmp , path + '.tmp' )
+            os.replace( path + '.tmp' , path )
+        os.replace( tmp , paths[0] )
+        self.catalog.record( names , state.get( 'epoch' ) , metrics , 'full' , sha1 , size )
+        if self.log_fn is not None:
+            self.log_fn( 'saved {} ( {:.1f}MB ) in {:.2f}s'.format( ' , '.join( names ) , size / 2**20 , time() - t ) )
+
+    def _write_loop( self ):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                self._write( *item )
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise( self ):
+        if self.error is not None:
+            error , self.error = self.error , None
+            raise error
+
+    def wait( self ):
+        '''blocks until every saved checkpoint is on disk'''
+        self.queue.join()
+        self._raise()
+
+    def close( self ):
+        if self.thread.is_alive():
+            self.queue.put( None )
+            self.thread.join()
+        self._raise()
@@ -15,7 +15,7 @@ if __name__ == "__main__":
 
 
     config.train['MIL'] = True
-    config.train['MIL_aggregate_fn'] = partial( torch.mean  , dim = 0 )
+    config.train['MIL_aggregate'] = 'mean'
     config.train['batch_size'] = 32
     config.train['val_batch_size'] = 32
 
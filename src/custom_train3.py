@@ -44,12 +44,13 @@ if __name__ == "__main__":
     config.net['name'] =  'gluoncv_resnet_v13.resnet34' 
     for config.train['mix_up'] in [True,False]:
         for config.data['smooth_label_epsilon'] in [0.1 , 0.0 ]:
+            #mix up halves the batch , accumulate two of them instead of doubling batch_size
             if config.train['mix_up']:
-                config.train['batch_size'] = batch_size * 2
+                config.train['accumulate_steps'] = 2
                 config.train['lr_bounds'] = [0,125]
             else:
                 config.train['lr_bounds'] = [0,75] 
-                config.train['batch_size'] = batch_size
+                config.train['accumulate_steps'] = 1
 
 
             config.parse_config()
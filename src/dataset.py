@@ -11,11 +11,10 @@ import pandas as pd
 from copy import deepcopy
 from math import ceil
 import os
+import json
+import warnings
 
-from torch._six import container_abcs
-from torch._six import string_classes, int_classes, FileNotFoundError
 from torch.utils.data.dataloader import default_collate
-import re
 
 
 
@@ -144,46 +143,40 @@ class ProteinDataset(data.Dataset):
 
 
 def mil_collate_fn( batch  ):
-    r"""Puts each data field into a tensor with outer dimension batch size"""
-
-    error_msg = "batch must contain tensors, numbers, dicts or lists; found {}"
-    elem_type = type(batch[0])
-    if isinstance(batch[0], torch.Tensor):
-        out = None
-        if torch.utils.data.dataloader._use_shared_memory:
-            # If we're in a background process, concatenate directly into a
-            # shared memory tensor to avoid an extra copy
-            numel = sum([x.numel() for x in batch])
-            storage = batch[0].storage()._new_shared(numel)
-            out = batch[0].new(storage)
-        return torch.stack(batch, 0, out=out)
-    elif elem_type.__module__ == 'numpy' and elem_type.__name__ != 'str_' \
-            and elem_type.__name__ != 'string_':
-        elem = batch[0]
-        if elem_type.__name__ == 'ndarray':
-            # array of string classes and object
-            if re.search('[SaUO]', elem.dtype.str) is not None:
-                raise TypeError(error_msg.format(elem.dtype))
-
-            return torch.stack([torch.from_numpy(b) for b in batch], 0)
-        if elem.shape == ():  # scalars
-            py_type = float if elem.dtype.name.startswith('float') else int
-            return numpy_type_map[elem.dtype.name](list(map(py_type, batch)))
-    elif isinstance(batch[0], int_classes):
-        return torch.LongTensor(batch)
-    elif isinstance(batch[0], float):
-        return torch.DoubleTensor(batch)
-    elif isinstance(batch[0], string_classes):
-        return batch
-    elif isinstance(batch[0], container_abcs.Mapping):
-        return {key: mil_collate_fn([d[key] for d in batch]) for key in batch[0]}
-    elif isinstance(batch[0], container_abcs.Sequence):
-        #transposed = zip(*batch)
-        #return [default_collate(samples) for samples in transposed]
-        #print('------------------sequence--------------------')
-        return [ mil_collate_fn( samples ) for samples in batch ]
-
-    raise TypeError((error_msg.format(type(batch[0]))))
+    r"""Collate MIL bags : the instances of all bags are written into one tensor ,
+    batch['img'][ batch['offsets'][i] : batch['offsets'][i+1] ] are the instances of the i-th bag
+    and batch['bag_index'][j] is the bag of the j-th instance"""
+
+    bags = [ d['img'] for d in batch ]
+    bag_sizes = torch.LongTensor( [ len( bag ) for bag in bags ] )
+    shape = ( int( bag_sizes.sum() ) , ) + tuple( bags[0].shape[1:] )
+    if torch.utils.data.get_worker_info() is not None:
+        # If we're in a background process, concatenate directly into a
+        # shared memory tensor to avoid an extra copy
+        numel = int( np.prod( shape ) )
+        storage = bags[0].untyped_storage()._new_shared( numel * bags[0].element_size() )
+        out = bags[0].new_empty( 0 ).set_( storage , 0 , shape )
+    else:
+        out = bags[0].new_empty( shape )
+    torch.cat( bags , 0 , out = out )
+
+    ret_dict = default_collate( [ { k:v for k,v in d.items() if k != 'img' } for d in batch ] )
+    ret_dict['img'] = out
+    ret_dict['offsets'] = torch.cat( [ torch.zeros( 1 , dtype = torch.long ) , bag_sizes.cumsum( 0 ) ] )
+    ret_dict['bag_index'] = torch.repeat_interleave( torch.arange( len( bags ) ) , bag_sizes )
+    return ret_dict
+
+
+def crop_instances( image , centers , cropsize ):
+    '''
+    slice square crops centered at centers ( (N,2) array of x,y ) out of a (H,W,C) image ,
+    zero padding the borders the same way the crop extractor does
+    return a (N,cropsize,cropsize,C) array
+    '''
+    pad = cropsize // 2
+    image = np.pad( image , ( (pad,pad) , (pad,pad) , (0,0) ) , mode = 'constant' , constant_values = 0 )
+    #center (x,y) of the original image is at (x+pad,y+pad) of the padded one , so the crop starts at (x,y)
+    return np.stack( [ image[ y : y + 2*pad , x : x + 2*pad ] for x,y in centers ] , 0 )
 
 
 class MILProteinDataset(data.Dataset):
@@ -225,7 +218,23 @@ class MILProteinDataset(data.Dataset):
         self.tta = tta
         self.df = df
         self.data_dir = data_dir
-        self.image_foramt = image_format
+        self.image_format = image_format
+        self.crop_mode = config.data['mil_crop_mode']
+        assert self.crop_mode in ['files','packed','centers']
+        if self.crop_mode == 'centers':
+            #crops are sliced on the fly from the full images in data_dir around the nucleus centers
+            centers_df = pd.read_csv( config.data['mil_centers_file'] )
+            #the extractor records the scale of the centers next to them
+            scale_fname = config.data['mil_centers_file'] + '.json'
+            if os.path.exists( scale_fname ):
+                with open( scale_fname ) as f:
+                    centers_scale = json.load( f )['scale']
+                if centers_scale != config.data['mil_crop_scale']:
+                    raise ValueError( "{} holds centers at scale {} but data['mil_crop_scale'] is {}".format( config.data['mil_centers_file'] , centers_scale , config.data['mil_crop_scale'] ) )
+            else:
+                warnings.warn( "{} has no recorded scale , assuming data['mil_crop_scale'] = {}".format( config.data['mil_centers_file'] , config.data['mil_crop_scale'] ) )
+            self.centers = { Id : g[['x','y']].values for Id , g in centers_df.groupby('Id') }
+        self._bag_sizes = None
         self.to_tensor = torchvision.transforms.ToTensor()
         self.mean = np.array([0.08069, 0.05258, 0.05487, 0.08282])
         self.std = np.array([0.13704, 0.10145, 0.15313, 0.13814])
@@ -245,25 +254,95 @@ class MILProteinDataset(data.Dataset):
 
     def __len__( self ):
         return len( self.df )
-    def __getitem__( self , idx ):
-        temp = os.listdir( self.data_dir + '/' + self.df.index[idx] )
-        #print(temp)
-        num_imgs = len( temp ) //4
+
+    def sample_instances( self , bag_size ):
+        """
+        indices of the instances to use , at most data['mil_max_bag_size'] randomly chosen ones during training
+        """
+        max_bag_size = self.config.data['mil_max_bag_size']
+        if not self.is_training or max_bag_size is None or bag_size <= max_bag_size:
+            return np.arange( bag_size )
+        return np.sort( np.random.choice( bag_size , max_bag_size , replace = False ) )
+
+    def bag_sizes( self ):
+        """
+        number of instances __getitem__ returns for every bag , without loading any crop
+        """
+        if self._bag_sizes is None:
+            bag_sizes = []
+            for Id in self.df.index:
+                if self.crop_mode == 'centers':
+                    bag_sizes.append( len( self.centers[Id] ) if Id in self.centers else 1 )
+                elif self.crop_mode == 'packed':
+                    #only reads the small centers member of the archive
+                    with np.load( self.data_dir + '/' + Id + '.npz' ) as f:
+                        bag_sizes.append( len( f['centers'] ) )
+                else:
+                    bag_sizes.append( len( os.listdir( self.data_dir + '/' + Id ) ) //4 )
+            self._bag_sizes = np.array( bag_sizes )
+        max_bag_size = self.config.data['mil_max_bag_size']
+        if self.is_training and max_bag_size is not None:
+            return np.minimum( self._bag_sizes , max_bag_size )
+        return self._bag_sizes
+
+    def load_bag( self , idx ):
+        """
+        return the crops of one image as a (N,H,W,4) uint8 array
+        """
+        if self.crop_mode == 'centers':
+            return self.crop_bag( idx )
+
+        bag_dir = self.data_dir + '/' + self.df.index[idx]
+        if self.crop_mode == 'packed':
+            #one (N,H,W,4) array per image , written by the crop extractor with --pack
+            with np.load( bag_dir + '.npz' ) as f:
+                crops = f['crops']
+            return crops[ self.sample_instances( len( crops ) ) ]
+
+        num_imgs = len( os.listdir( bag_dir ) ) //4
         img_list = []
-        #print( num_imgs )
-        for i in range( num_imgs ):
+        for i in self.sample_instances( num_imgs ):
             img_channel_list = []
             for color in ['red','green','blue','yellow']:
-                fname = self.data_dir + '/' + self.df.index[idx] + '/' + str(i) +'_{}.{}'.format( color , self.image_format )
+                fname = bag_dir + '/' + str(i) +'_{}.{}'.format( color , self.image_format )
                 img = cv2.imread( fname , cv2.IMREAD_GRAYSCALE  )
-                #print( img )
-                if not (self.config.net['input_shape'][0] == 128 and self.config.net['input_shape'][1] == 128):
-                    img = cv2.resize( img , self.config.net['input_shape'] ,  cv2.INTER_LANCZOS4 )
-                img = img.reshape( img.shape[0] , img.shape[1] , 1  )
                 img_channel_list.append( img )
+            img_list.append( np.stack( img_channel_list , axis = -1 ) )
+        return np.stack( img_list , axis = 0 )
+
+    def crop_bag( self , idx ):
+        data_dir = self.data_dir
+        image_format = self.image_format
+        if hasattr( self.df , 'Directory'):
+            data_dir = self.df.Directory[idx]
+        if hasattr( self.df , 'ImageFormat' ):
+            image_format = self.df.ImageFormat[idx]
+        Id = self.df.index[idx]
+        img = np.stack( [ cv2.imread( data_dir + '/' + Id + '_{}.{}'.format( color , image_format ) , cv2.IMREAD_GRAYSCALE ) for color in ['red','green','blue','yellow'] ] , -1 )
+        scale = self.config.data['mil_crop_scale']
+        if scale != 1:
+            #same downscaling as the segmentation step , centers are in pixels of the rescaled image
+            img = cv2.resize( img , ( img.shape[1] // scale , img.shape[0] // scale ) , interpolation = cv2.INTER_LANCZOS4 )
+
+        if Id in self.centers:
+            centers = self.centers[Id]
+        else:
+            #no nucleus found , fall back to one crop at the image center
+            centers = np.array( [[ img.shape[1] // 2 , img.shape[0] // 2 ]] )
+        centers = centers[ self.sample_instances( len( centers ) ) ]
+        jitter = self.config.data['mil_center_jitter']
+        if self.is_training and jitter > 0:
+            centers = centers + np.random.randint( -jitter , jitter + 1 , centers.shape )
+            centers = np.clip( centers , 0 , [ img.shape[1] - 1 , img.shape[0] - 1 ] )
+        return crop_instances( img , centers , self.config.data['mil_crop_size'] )
+
+    def __getitem__( self , idx ):
+        bag = self.load_bag( idx )
+        img_list = []
+        for img in bag:
+            if not (self.config.net['input_shape'][0] == img.shape[1] and self.config.net['input_shape'][1] == img.shape[0]):
+                img = cv2.resize( img , self.config.net['input_shape'] ,  cv2.INTER_LANCZOS4 )
 
-            img =  np.concatenate( img_channel_list , axis = -1 )
-                    
             img = self.to_pil( img )
 
             if self.is_training:
@@ -286,14 +365,9 @@ class MILProteinDataset(data.Dataset):
                 img = self.to_tensor( img )
                 img = self.normalize( img )
             img_list.append( img )
-        imgs =  img_list 
-        #for img in imgs:
-        #    print(img.shape)
+        imgs = torch.stack( img_list , 0 )
 
 
-        #assert img.shape[0]==4 and img.shape[1]==512 and img.shape[2]==512
-                
-            #img = ( self.to_tensor( img ) - 0.5 ) *2.0
         ret_dict = { 'img' : imgs  }
         if self.has_label:
             ret_dict['label'] = np.zeros(len(self.label_to_name_dict),np.float32)
@@ -305,4 +379,86 @@ class MILProteinDataset(data.Dataset):
         return ret_dict
 
 
+class BagBatchSampler(data.Sampler):
+    """
+    batch sampler for MILProteinDataset which packs bags into a batch until it holds max_instances instances ,
+    so that the memory of a step does not depend on how many cells the images have.
+    when shuffling , bags are sorted by size inside buckets of bucket_size random bags to make the batches even.
+    with num_replicas > 1 every process plans the same batches from seed and iterates over its rank-th share. shuffled
+    ( training ) batches left over by an uneven split are dropped so that every process steps as many times , ordered
+    ( validation ) batches are all kept , the low ranks getting one more
+    """
+    def __init__( self , bag_sizes , max_instances , shuffle = True , bucket_size = 100 , drop_last = False , num_replicas = 1 , rank = 0 , seed = None ):
+        self.bag_sizes = np.asarray( bag_sizes )
+        self.max_instances = max_instances
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.random = np.random if seed is None else np.random.RandomState( seed )
+        #batches are planned one epoch ahead so that len() matches the next iteration
+        self.batches = self.plan()
+
+    def plan( self ):
+        if self.shuffle:
+            indices = self.random.permutation( len( self.bag_sizes ) )
+            buckets = [ indices[i:i+self.bucket_size] for i in range( 0 , len( indices ) , self.bucket_size ) ]
+            indices = np.concatenate( [ b[ np.argsort( self.bag_sizes[b] , kind = 'stable' ) ] for b in buckets ] )
+        else:
+            indices = np.arange( len( self.bag_sizes ) )
+
+        batches = []
+        batch = []
+        num_instances = 0
+        for idx in indices:
+            if len( batch ) > 0 and num_instances + self.bag_sizes[idx] > self.max_instances:
+                batches.append( batch )
+                batch = []
+                num_instances = 0
+            batch.append( int( idx ) )
+            num_instances += self.bag_sizes[idx]
+        if len( batch ) > 0 and not self.drop_last:
+            batches.append( batch )
+
+        if self.shuffle:
+            batches = [ batches[i] for i in self.random.permutation( len( batches ) ) ]
+        if self.num_replicas > 1:
+            if self.shuffle:
+                batches = batches[ : len( batches ) // self.num_replicas * self.num_replicas ]
+            batches = batches[ self.rank :: self.num_replicas ]
+        return batches
+
+    def __iter__( self ):
+        batches = self.batches
+        for batch in batches:
+            yield batch
+        self.batches = self.plan()
+
+    def __len__( self ):
+        return len( self.batches )
+
+class DistributedWeightedSampler(data.Sampler):
+    """
+    WeightedRandomSampler ( with replacement ) split between num_replicas processes : every process draws the same
+    num_samples indices from seed + epoch and keeps its rank-th share. call set_epoch before every epoch
+    """
+    def __init__( self , weights , num_samples , num_replicas = 1 , rank = 0 , seed = 0 ):
+        self.weights = torch.as_tensor( weights , dtype = torch.float64 )
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = int( ceil( num_samples / num_replicas ) )
+
+    def set_epoch( self , epoch ):
+        self.epoch = epoch
 
+    def __iter__( self ):
+        g = torch.Generator()
+        g.manual_seed( self.seed + self.epoch )
+        indices = torch.multinomial( self.weights , self.num_samples * self.num_replicas , replacement = True , generator = g )
+        return iter( indices[ self.rank :: self.num_replicas ].tolist() )
+
+    def __len__( self ):
+        return self.num_samples
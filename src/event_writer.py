@@ -0,0 +1,136 @@
+'''
+Minimal tensorboard event file writer , so logging does not need to import tensorflow.
+
+The few protobuf messages used by log.TensorBoardX ( Event , Summary , Summary.Value , Summary.Image ,
+HistogramProto ) are encoded by hand and written as tfrecords , the format tf.summary.FileWriter writes:
+    uint64 length , uint32 masked crc32c of length , data , uint32 masked crc32c of data
+
+crc32c comes from the crc32c package when it is installed , a pure python table otherwise.
+'''
+
+import os
+import struct
+import socket
+import threading
+from time import time
+
+try:
+    from crc32c import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+def _make_crc_table():
+    table = []
+    for i in range( 256 ):
+        crc = i
+        for _ in range( 8 ):
+            crc = ( crc >> 1 ) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append( crc )
+    return table
+
+_crc_table = _make_crc_table()
+
+def crc32c( data ):
+    if _crc32c is not None:
+        return _crc32c( data )
+    crc = 0xFFFFFFFF
+    table = _crc_table
+    for b in data:
+        crc = table[ ( crc ^ b ) & 0xFF ] ^ ( crc >> 8 )
+    return crc ^ 0xFFFFFFFF
+
+def masked_crc32c( data ):
+    crc = crc32c( data )
+    return ( ( ( crc >> 15 ) | ( crc << 17 ) ) + 0xA282EAD8 ) & 0xFFFFFFFF
+
+#protobuf wire format
+def _varint( n ):
+    out = bytearray()
+    n &= 0xFFFFFFFFFFFFFFFF
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append( b | 0x80 )
+        else:
+            out.append( b )
+            return bytes( out )
+
+def _key( field , wire_type ):
+    return _varint( ( field << 3 ) | wire_type )
+
+def _int_field( field , n ):
+    return _key( field , 0 ) + _varint( int( n ) )
+
+def _double_field( field , x ):
+    return _key( field , 1 ) + struct.pack( '<d' , float( x ) )
+
+def _float_field( field , x ):
+    return _key( field , 5 ) + struct.pack( '<f' , float( x ) )
+
+def _bytes_field( field , data ):
+    if isinstance( data , str ):
+        data = data.encode( 'utf-8' )
+    return _key( field , 2 ) + _varint( len( data ) ) + data
+
+def _packed_doubles_field( field , values ):
+    return _bytes_field( field , struct.pack( '<{}d'.format( len( values ) ) , *values ) )
+
+'''
+Summary builders , they return the encoded Summary message holding one value
+'''
+
+def scalar_summary( tag , value ):
+    return _bytes_field( 1 , _bytes_field( 1 , tag ) + _float_field( 2 , value ) )
+
+def histogram_summary( tag , min , max , num , sum , sum_squares , bucket_limit , bucket ):
+    histo = _double_field( 1 , min ) + _double_field( 2 , max ) + _double_field( 3 , num ) + _double_field( 4 , sum ) + _double_field( 5 , sum_squares )
+    histo += _packed_doubles_field( 6 , bucket_limit ) + _packed_doubles_field( 7 , bucket )
+    return _bytes_field( 1 , _bytes_field( 1 , tag ) + _bytes_field( 5 , histo ) )
+
+def image_summary( tag , encoded_image , height , width , colorspace ):
+    image = _int_field( 1 , height ) + _int_field( 2 , width ) + _int_field( 3 , colorspace ) + _bytes_field( 4 , encoded_image )
+    return _bytes_field( 1 , _bytes_field( 1 , tag ) + _bytes_field( 4 , image ) )
+
+def merge_summaries( summaries ):
+    '''Summary messages are concatenations of their values , so several summaries are merged by joining them'''
+    return b''.join( summaries )
+
+class EventFileWriter():
+    '''
+    Writes the events of one run directory , the file events.out.tfevents.{time}.{hostname} is only created by the
+    first event. add_summary can be called from any thread.
+    '''
+    def __init__( self , logdir ):
+        self.logdir = logdir
+        self.fp = None
+        self.lock = threading.Lock()
+
+    def _open( self ):
+        os.makedirs( self.logdir , exist_ok = True )
+        fname = os.path.join( self.logdir , 'events.out.tfevents.{:010d}.{}'.format( int( time() ) , socket.gethostname() ) )
+        self.fp = open( fname , 'ab' )
+        self._write_event( _bytes_field( 3 , 'brain.Event:2' ) )
+
+    def _write_event( self , fields ):
+        data = _double_field( 1 , time() ) + fields
+        header = struct.pack( '<Q' , len( data ) )
+        self.fp.write( header + struct.pack( '<I' , masked_crc32c( header ) ) + data + struct.pack( '<I' , masked_crc32c( data ) ) )
+
+    def add_summary( self , summary , step ):
+        '''summary: encoded Summary message , see the *_summary builders'''
+        with self.lock:
+            if self.fp is None:
+                self._open()
+            self._write_event( _int_field( 2 , step ) + _bytes_field( 5 , summary ) )
+
+    def flush( self ):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.flush()
+
+    def close( self ):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
@@ -0,0 +1,107 @@
+'''
+Feature bank of a frozen backbone , for the epochs where only net.module.classifier is trained
+( train['freeze_feature_layer_epochs'] ).
+
+The backbone is run once per augmentation pass over the dataset and the input of the classifier ( the pooled
+features ) of every image , or of every instance of a MIL bag , is written to a fp16 file read back as a memmap.
+The head is then trained from the bank without any image loading nor backbone forward , like fastai precompute.
+'''
+
+import os
+import json
+import numpy as np
+import torch
+import torch.utils.data as data
+from tqdm import tqdm
+
+class FeatureBank():
+    '''
+    ARGUMENTS:
+    path: directory of the bank files ( features.f16 , offsets.npy , labels.npy , meta.json )
+    '''
+    def __init__( self , path ):
+        self.path = path
+
+    def build( self , net , dataset , collate_fn , batch_size , device , autocast , num_augmentations = 1 , num_workers = 8 ):
+        '''
+        runs net over dataset num_augmentations times ( different random augmentations when dataset is a training
+        one ) and stores the classifier inputs. the backbone runs in eval mode , with its batch norm statistics.
+        net must return { 'fc' : net.module.classifier( features ) } , checked on the first batch.
+        the forward runs on net.module , a DataParallel wrapper would run the hook once per replica and device
+        '''
+        os.makedirs( self.path , exist_ok = True )
+        net = net.module if hasattr( net , 'module' ) else net
+        classifier = net.classifier
+        captured = []
+        hook = classifier.register_forward_pre_hook( lambda module , inputs : captured.append( inputs[0] ) )
+        training = net.training
+        net.eval()
+        offsets = np.zeros( ( num_augmentations , len( dataset ) + 1 ) , np.int64 )
+        labels = None
+        num_rows = 0
+        try:
+            with open( os.path.join( self.path , 'features.f16' ) , 'wb' ) as f , torch.no_grad():
+                for k in range( num_augmentations ):
+                    dataloader = data.DataLoader( dataset , batch_size = batch_size , collate_fn = collate_fn , shuffle = False , drop_last = False , num_workers = num_workers )
+                    idx = 0
+                    for batch in tqdm( dataloader , desc = 'feature bank {}/{}'.format( k + 1 , num_augmentations ) , leave = False ):
+                        del captured[:]
+                        with autocast():
+                            results = net( batch['img'].to( device ) )
+                        assert len( captured ) == 1 and len( captured[0] ) == len( batch['img'] ) , 'the classifier ran {} times on {} rows for {} rows'.format( len( captured ) , [ len( c ) for c in captured ] , len( batch['img'] ) )
+                        features = captured[0]
+                        if num_rows == 0:
+                            assert list( results.keys() ) == ['fc'] , 'the feature bank needs a net whose only output is its classifier'
+                            with autocast():
+                                fc = classifier( features )
+                            assert torch.allclose( fc.float() , results['fc'].float() , atol = 1e-3 ) , 'the classifier output is not the output of the net'
+                            feature_shape = tuple( features.shape[1:] )
+                        #always fp16 on disk , whatever the autocast dtype of the forward
+                        features = features.float().half()
+                        assert torch.isfinite( features ).all() , 'features out of the fp16 range'
+                        f.write( features.cpu().numpy().tobytes() )
+                        num_rows += len( features )
+
+                        sizes = np.diff( batch['offsets'].numpy() ) if 'offsets' in batch else np.ones( len( batch['label'] ) , np.int64 )
+                        offsets[ k , idx + 1 : idx + 1 + len( sizes ) ] = offsets[ k , idx ] + np.cumsum( sizes )
+                        if k == 0:
+                            label = batch['label'].numpy()
+                            labels = label if labels is None else np.concatenate( [ labels , label ] )
+                        idx += len( sizes )
+                    if k + 1 < num_augmentations:
+                        offsets[ k + 1 , 0 ] = offsets[ k , -1 ]
+        finally:
+            hook.remove()
+            net.train( training )
+        np.save( os.path.join( self.path , 'offsets.npy' ) , offsets )
+        np.save( os.path.join( self.path , 'labels.npy' ) , labels )
+        with open( os.path.join( self.path , 'meta.json' ) , 'w' ) as f:
+            json.dump( { 'feature_shape' : feature_shape , 'num_rows' : num_rows , 'num_augmentations' : num_augmentations , 'dtype' : 'float16' } , f )
+        return self
+
+    def dataset( self , mil = False ):
+        return FeatureBankDataset( self.path , mil )
+
+class FeatureBankDataset(data.Dataset):
+    '''
+    items of a FeatureBank in the format of ProteinDataset ( 'img' is the feature of the image ) or , with mil , of
+    MILProteinDataset ( 'img' holds the features of the instances , to collate with mil_collate_fn ).
+    every item comes from a random augmentation pass , its features are float32 whatever the precision of the training
+    '''
+    def __init__( self , path , mil = False ):
+        with open( os.path.join( path , 'meta.json' ) ) as f:
+            meta = json.load( f )
+        self.feature_shape = tuple( meta['feature_shape'] )
+        assert meta.get( 'dtype' , 'float16' ) == 'float16'
+        self.features = np.memmap( os.path.join( path , 'features.f16' ) , np.float16 , 'r' , shape = ( meta['num_rows'] , ) + self.feature_shape )
+        self.offsets = np.load( os.path.join( path , 'offsets.npy' ) )
+        self.labels = np.load( os.path.join( path , 'labels.npy' ) )
+        self.mil = mil
+
+    def __len__( self ):
+        return len( self.labels )
+
+    def __getitem__( self , idx ):
+        k = np.random.randint( len( self.offsets ) )
+        features = torch.from_numpy( self.features[ self.offsets[k,idx] : self.offsets[k,idx+1] ].astype( np.float32 ) )
+        return { 'img' : features if self.mil else features[0] , 'label' : self.labels[idx] }
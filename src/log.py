@@ -5,7 +5,7 @@ import torch
 import numpy as np
 import torchvision.models as models
 import utils as utils
-import tensorflow as tf
+import event_writer
 #from tensorboardX import SummaryWriter
 import os, sys
 import importlib
@@ -14,6 +14,10 @@ import datetime
 from tqdm import tqdm
 from time import time
 from sklearn.metrics import f1_score
+import threading
+import queue
+import atexit
+import warnings
 
 class LogParser:
     def __init__(self):
@@ -22,7 +26,8 @@ class LogParser:
     def parse_log_dict( self,  log_dicts , epoch , lr , num_imgs , config):
         for tag in log_dicts:
             #d = { k:log_dicts[tag][k] for k in filter( lambda x : isinstance(log_dicts[tag][x],float) , log_dicts[tag] ) } 
-            if 'f1_score_label' in log_dicts[tag]:
+            #MetricAccumulator already gives the macro f1 , computed from the counts
+            if 'f1_score_label' in log_dicts[tag] and 'macro_f1_score' not in log_dicts[tag]:
                 log_dicts[tag]['macro_f1_score'] = f1_score( log_dicts[tag]['f1_score_label'] , log_dicts[tag]['f1_score_pred']  , average = 'macro' )
             #log_dicts[tag] = d
 
@@ -80,8 +85,96 @@ class LogParser:
 
 
 
+class MetricAccumulator:
+    '''
+    running sums of the loss dicts of an epoch , kept on the device the losses are computed on.
+    scalars are averaged over the updates , the tp/fp/fn/tn vectors are summed per class and the macro f1 comes from
+    these counts ( same value as sklearn f1_score average = 'macro' ) , the f1_score_label / f1_score_pred matrices
+    are never stored. values only go to the host in interval() and result()
+    with distributed , interval() and result() are collective : the scalars are averaged and the counts summed over
+    the processes , every process must call them at the same steps. result() weights the processes by their number of
+    updates , the validation ones may differ by a batch
+    '''
+    count_keys = ['tp','fp','fn','tn']
+    def __init__( self , distributed = False ):
+        self.distributed = distributed
+        self.sums = {}
+        self.num = 0
+        self.interval_sums = {}
+        self.interval_num = 0
+
+    def update( self , loss_dict ):
+        loss_dict = { k : v.detach() for k,v in loss_dict.items() if k != 'total' }
+        if 'f1_score_label' in loss_dict and 'tp' not in loss_dict:
+            label , pred = loss_dict['f1_score_label'] , loss_dict['f1_score_pred']
+            loss_dict['tp'] = ( label & pred ).long().sum( 0 , True )
+            loss_dict['fp'] = ( ~label & pred ).long().sum( 0 , True )
+            loss_dict['fn'] = ( label & ~pred ).long().sum( 0 , True )
+            loss_dict['tn'] = ( ~label & ~pred ).long().sum( 0 , True )
+        for k,v in loss_dict.items():
+            if k in self.count_keys:
+                self.sums[k] = self.sums[k] + v if k in self.sums else v
+            elif v.dim() == 0:
+                v = v.float()
+                self.sums[k] = self.sums[k] + v if k in self.sums else v
+                self.interval_sums[k] = self.interval_sums[k] + v if k in self.interval_sums else v
+        self.num += 1
+        self.interval_num += 1
+
+    def all_reduce( self , tensors , mean ):
+        '''sum ( or mean ) over the processes of a list of tensors , in one all_reduce'''
+        if not self.distributed or len( tensors ) == 0:
+            return tensors
+        flat = torch.cat( [ t.double().view( -1 ) for t in tensors ] )
+        torch.distributed.all_reduce( flat )
+        if mean:
+            flat /= torch.distributed.get_world_size()
+        return [ x.view( t.shape ).to( t.dtype ) for x , t in zip( flat.split( [ t.numel() for t in tensors ] ) , tensors ) ]
+
+    def interval( self ):
+        '''
+        mean of the scalars since the last call , one device sync
+        '''
+        keys = list( self.interval_sums.keys() )
+        values = self.all_reduce( [ self.interval_sums[k] for k in keys ] , mean = True )
+        values = torch.stack( values ).div_( max( 1 , self.interval_num ) ).tolist() if keys else []
+        self.interval_sums = {}
+        self.interval_num = 0
+        return dict( zip( keys , values ) )
+
+    def result( self ):
+        '''
+        log dict of the epoch : mean scalars , (1,num_classes) numpy counts and macro_f1_score
+        '''
+        log_dict = {}
+        counts = [ k for k in self.sums if k in self.count_keys ]
+        scalars = [ k for k in self.sums if k not in self.count_keys ]
+        sums = dict( zip( counts , self.all_reduce( [ self.sums[k] for k in counts ] , mean = False ) ) )
+        device = self.sums[ scalars[0] ].device if len( scalars ) else 'cpu'
+        scalar_sums = self.all_reduce( [ self.sums[k] for k in scalars ] + [ torch.tensor( float( self.num ) , device = device ) ] , mean = False )
+        num = float( scalar_sums.pop() )
+        sums.update( zip( scalars , scalar_sums ) )
+        for k,v in sums.items():
+            if k in self.count_keys:
+                log_dict[k] = v.cpu().numpy()
+            else:
+                log_dict[k] = float( v ) / num
+        if all( k in log_dict for k in self.count_keys ):
+            tp , fp , fn = [ log_dict[k].sum(0).astype( np.float64 ) for k in ['tp','fp','fn'] ]
+            denominator = 2 * tp + fp + fn
+            #classes without any label nor prediction count as 0 , like sklearn
+            f1 = np.where( denominator > 0 , 2 * tp / np.maximum( denominator , 1 ) , 0 )
+            log_dict['macro_f1_score'] = float( f1.mean() )
+        return log_dict
+
+
 class TensorBoardX:
-    def __init__(self,config , log_dir , log_type = ['train','val','net'] ):
+    '''
+    add_* only put the event in a queue , a background thread builds the summaries , writes them and flushes
+    every flush_secs seconds or flush_events events , and on close(). a full queue drops the event rather than
+    blocking the training step. an error of the writer thread is raised by the next add_* or close()
+    '''
+    def __init__(self,config , log_dir , log_type = ['train','val','net'] , flush_secs = 10 , flush_events = 1000 , max_queue = 10000 ):
         os.system('mkdir -p {}'.format(log_dir))
         self.path = '{}'.format(log_dir )
         os.system('mkdir -p {}'.format(self.path))
@@ -90,7 +183,7 @@ class TensorBoardX:
         self.writer = {}
         for k in log_type:
             #self.writer[k] = SummaryWriter( self.path +'/' + k )
-            self.writer[k] = tf.summary.FileWriter( self.path +'/' + k )
+            self.writer[k] = event_writer.EventFileWriter( self.path +'/' + k )
 
 
         #Export run arguments
@@ -109,17 +202,87 @@ class TensorBoardX:
 
         #os.system('cp {} {}/'.format(config_filename , self.path))
 
+        self.flush_secs = flush_secs
+        self.flush_events = flush_events
+        self.queue = queue.Queue( max_queue )
+        self.num_dropped = 0
+        self.error = None
+        self.thread = threading.Thread( target = self._write_loop , daemon = True )
+        self.thread.start()
+        atexit.register( self.close )
+
     def tag(self,tag):
         return tag.replace('.','/')
+
+    def _put( self , item ):
+        if self.error is not None:
+            error , self.error = self.error , None
+            raise error
+        try:
+            self.queue.put_nowait( item )
+        except queue.Full:
+            if self.num_dropped == 0:
+                warnings.warn( 'tensorboard queue full , dropping events' )
+            self.num_dropped += 1
+
+    def _write_loop( self ):
+        pending = 0
+        last_flush = time()
+        while True:
+            try:
+                item = self.queue.get( timeout = max( 0.01 , self.flush_secs - ( time() - last_flush ) ) )
+            except queue.Empty:
+                item = 'flush'
+            if item is None or item == 'flush' or pending >= self.flush_events or time() - last_flush >= self.flush_secs:
+                if pending > 0:
+                    for writer in self.writer.values():
+                        writer.flush()
+                pending = 0
+                last_flush = time()
+            if item is None:
+                self.queue.task_done()
+                return
+            if item == 'flush':
+                continue
+            kind , logtype , args , step = item
+            try:
+                summary = getattr( self , '_{}_summary'.format( kind ) )( *args )
+                self.writer[logtype].add_summary( summary , step )
+                pending += 1
+            except Exception as e:
+                #e.g. a non finite histogram , raised later in the training thread so name the tag
+                if self.error is None:
+                    self.error = RuntimeError( 'tensorboard {} {} : {}'.format( kind , args[0] , e ) )
+            finally:
+                self.queue.task_done()
+
+    def flush( self ):
+        '''wait until every queued event is written and flushed'''
+        self.queue.join()
+        for writer in self.writer.values():
+            writer.flush()
+
+    def close( self ):
+        if self.thread.is_alive():
+            self.queue.put( None )
+            self.thread.join()
+            for writer in self.writer.values():
+                writer.close()
+        if self.error is not None:
+            error , self.error = self.error , None
+            raise error
                 
     def add_scalar(self, tag, val, step , logtype):
         #self.writer[logtype].add_scalar(tag, val, step)
-        tag=self.tag( tag )
         if isinstance(val,torch.Tensor):
-            val = val.detach().cpu().numpy()
-        summary = tf.Summary( value=[tf.Summary.Value(tag=tag,simple_value=val)] )
-        self.writer[logtype].add_summary( summary , step )
-        self.writer[logtype].flush()
+            #read back by the writer thread
+            val = val.detach()
+        self._put( ( 'scalar' , logtype , ( self.tag( tag ) , val ) , step ) )
+
+    def _scalar_summary( self , tag , val ):
+        if isinstance(val,torch.Tensor):
+            val = float( val.cpu() )
+        return event_writer.scalar_summary( tag , val )
 
     '''
     def add_scalars(self, tag, group_dict, step , logtype):
@@ -133,59 +296,61 @@ class TensorBoardX:
     '''
     def add_images(self, tag, images, step , logtype):
         """Log a list of images."""
+        images = [ img.detach().clone() if isinstance( img , torch.Tensor ) else img for img in images ]
+        self._put( ( 'images' , logtype , ( self.tag( tag ) , images ) , step ) )
 
-        tag=self.tag(tag)
+    def _images_summary( self , tag , images ):
+        #only needed when images are logged
+        import cv2
         img_summaries = []
         for i, img in enumerate(images):
             # Write the image to a string
             if isinstance(img , torch.Tensor):
                 img = img.detach().cpu().numpy()
-            s = BytesIO()
-            scipy.misc.toimage(img).save(s, format="png")
+            img = np.asarray( img )
+            if img.dtype != np.uint8:
+                #scaled to the full range , like scipy.misc.toimage
+                low , high = float( img.min() ) , float( img.max() )
+                img = ( ( img - low ) * ( 255 / max( high - low , 1e-12 ) ) + 0.5 ).astype( np.uint8 )
+            channels = 1 if img.ndim == 2 else img.shape[2]
+            if channels == 3:
+                img = img[:,:,::-1]
+            ok , buf = cv2.imencode( '.png' , np.ascontiguousarray( img ) )
 
-            # Create an Image object
-            img_sum = tf.Summary.Image(encoded_image_string=s.getvalue(),
-                                       height=img.shape[0],
-                                       width=img.shape[1])
             # Create a Summary value
-            img_summaries.append(tf.Summary.Value(tag='%s/%d' % (tag, i), image=img_sum))
+            img_summaries.append( event_writer.image_summary( '%s/%d' % (tag, i) , buf.tobytes() , img.shape[0] , img.shape[1] , channels ) )
 
-        # Create and write Summary
-        summary = tf.Summary(value=img_summaries)
-        self.writer[logtype].add_summary(summary, step)
-        self.writer[logtype].flush()
+        # Create Summary
+        return event_writer.merge_summaries( img_summaries )
 
     def add_histogram(self, tag, values, step, logtype, bins=1000):
         """Log a histogram of the tensor of values."""
-
-        tag=self.tag(tag)
-        # Create a histogram using numpy
-
         if isinstance(values , torch.Tensor):
-            values = values.detach().cpu().numpy()
-        counts, bin_edges = np.histogram(values, bins=bins)
+            #reduced on the device , only bins + 5 numbers are read back by the writer thread
+            values = tensor_histogram( values , bins )
+        self._put( ( 'histogram' , logtype , ( self.tag( tag ) , values , bins ) , step ) )
 
-        # Fill the fields of the histogram proto
-        hist = tf.HistogramProto()
-        hist.min = float(np.min(values))
-        hist.max = float(np.max(values))
-        hist.num = int(np.prod(values.shape))
-        hist.sum = float(np.sum(values))
-        hist.sum_squares = float(np.sum(values ** 2))
+    def _histogram_summary( self , tag , values , bins ):
+        if isinstance(values , torch.Tensor):
+            stats = values.cpu().double().numpy()
+            low , high , num , total , total_squares = stats[:5]
+            counts = stats[5:]
+            if not np.isfinite( stats[:5] ).all():
+                raise ValueError( 'values are not finite' )
+            if low == high:
+                low , high = low - 0.5 , high + 0.5
+            bin_edges = np.linspace( low , high , bins + 1 )
+        else:
+            # Create a histogram using numpy
+            counts, bin_edges = np.histogram(values, bins=bins)
+            low , high , num = float(np.min(values)) , float(np.max(values)) , int(np.prod(values.shape))
+            total , total_squares = float(np.sum(values)) , float(np.sum(values ** 2))
 
         # Drop the start of the first bin
         bin_edges = bin_edges[1:]
 
-        # Add bin edges and counts
-        for edge in bin_edges:
-            hist.bucket_limit.append(edge)
-        for c in counts:
-            hist.bucket.append(c)
-
-        # Create and write Summary
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, histo=hist)])
-        self.writer[logtype].add_summary(summary, step)
-        self.writer[logtype].flush()
+        # Create Summary
+        return event_writer.histogram_summary( tag , low , high , num , total , total_squares , bin_edges.tolist() , counts.tolist() )
 
     '''
     def add_image_single(self, tag, x, step , logtype):
@@ -223,17 +388,83 @@ class TensorBoardX:
             sys.stdout.flush()
  
 
-def log_net_params(tb,net,epoch,epoch_length):
-    for k,v in net.named_parameters():
-        if v.requires_grad and v.grad is not None:
-            try:
-                tb.add_histogram( k , v , (epoch+1)*epoch_length , 'net' )
-            except Exception as e:
-                print( "{} is not finite".format(k)   )
-                raise e
-            try:
-                tb.add_histogram( k+'_grad' , v.grad , (epoch+1)*epoch_length , 'net' )
-            except Exception as e:
-                print( "{}.grad is not finite".format(k)   )
-                raise e
+class NullTensorBoardX:
+    '''
+    stands in for TensorBoardX on the processes that do not log ( rank > 0 of a distributed run ) : same path ,
+    every method does nothing
+    '''
+    def __init__( self , config , log_dir , *args , **kwargs ):
+        self.path = log_dir
+
+    def __getattr__( self , name ):
+        return lambda *args , **kwargs : None
+
+def tensor_histogram( values , bins ):
+    '''
+    np.histogram of a tensor computed on its device without any synchronization
+
+    returns the float64 tensor [min,max,num,sum,sum_squares,counts of the bins...] , non finite values make the
+    statistics non finite and are left out of the counts
+    '''
+    values = values.detach().float().reshape( -1 )
+    low , high = torch.aminmax( values )
+    #same range and bins as np.histogram , the last bin includes high
+    constant = low == high
+    low_edge = torch.where( constant , low - 0.5 , low )
+    high_edge = torch.where( constant , high + 0.5 , high )
+    finite = torch.isfinite( values )
+    idx = ( ( values - low_edge ) * ( bins / ( high_edge - low_edge ) ) ).floor_()
+    #nan indices when the range itself is not finite
+    idx = torch.where( torch.isfinite( idx ) , idx , torch.zeros_like( idx ) ).clamp_( 0 , bins - 1 ).long()
+    counts = torch.zeros( bins , dtype = torch.float64 , device = values.device ).index_add_( 0 , idx , finite.double() )
+    num = torch.full( () , values.numel() , dtype = torch.float32 , device = values.device )
+    stats = torch.stack( [ low , high , num , values.sum() , values.pow( 2 ).sum() ] ).double()
+    return torch.cat( [ stats , counts ] )
+
+class ParamMonitor:
+    '''
+    Histograms of the weights and gradients of a net.
+
+    ARGUMENTS:
+    net: the model , only the parameters with a gradient are logged
+    num_layers: parameters logged by each log() call , in round robin so the whole net is covered every
+                len(parameters)/num_layers calls. None logs every parameter at every call
+    bins: histogram bins
+    '''
+    def __init__( self , net , num_layers = None , bins = 1000 ):
+        self.net = net
+        self.num_layers = num_layers
+        self.bins = bins
+        self.position = 0
+
+    def parameters( self ):
+        return [ (k,v) for k,v in self.net.named_parameters() if v.requires_grad and v.grad is not None ]
+
+    def log( self , tb , step , logtype = 'net' ):
+        params = self.parameters()
+        if self.num_layers is not None and self.num_layers < len( params ):
+            params = [ params[ ( self.position + i ) % len( params ) ] for i in range( self.num_layers ) ]
+            self.position += self.num_layers
+        for k,v in params:
+            tb.add_histogram( k , v , step , logtype , bins = self.bins )
+            tb.add_histogram( k+'_grad' , v.grad , step , logtype , bins = self.bins )
+
+    def non_finite( self ):
+        '''
+        names of the weights ( k ) and gradients ( k_grad ) with nan or inf values , with a single read back from the
+        device : the norms of all tensors at once , a non finite value gives a non finite norm
+        '''
+        params = self.parameters()
+        names = [ k for k,v in params ] + [ k+'_grad' for k,v in params ]
+        tensors = [ v.detach() for k,v in params ] + [ v.grad.detach() for k,v in params ]
+        if len( tensors ) == 0:
+            return []
+        finite = torch.isfinite( torch.stack( [ n.float() for n in torch._foreach_norm( tensors ) ] ) ).tolist()
+        #the norm of large finite values can overflow , those are checked element wise
+        return [ k for k , v , f in zip( names , tensors , finite ) if not f and not torch.isfinite( v ).all() ]
 
+def log_net_params(tb,net,epoch,epoch_length,monitor=None):
+    '''end of epoch histograms , through monitor ( the ParamMonitor of the training , with its num_layers ) when given'''
+    if monitor is None:
+        monitor = ParamMonitor( net )
+    monitor.log( tb , (epoch+1)*epoch_length )
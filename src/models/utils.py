@@ -1,5 +1,7 @@
 #from TSN lr policy 
 import torch
+from torch.utils.checkpoint import checkpoint as _checkpoint
+import time
 def get_optim_config(net,lr_for_parts = [1]):
     first_conv_weight = []
     first_conv_bias = []
@@ -88,3 +90,81 @@ def get_optim_config(net,lr_for_parts = [1]):
     ]
     '''
 
+
+'''
+Activation checkpointing of parts of a net ( config.net['checkpoint_segments'] ) : the activations inside a
+checkpointed module are not kept for the backward pass , its forward is run again during the backward instead.
+The dropout masks are the same in both runs ( torch.utils.checkpoint restores the rng state ) and the batch norm
+running statistics are restored after the second run so they are only updated once.
+'''
+
+class CheckpointedModule():
+    '''mixin placed in front of the class of a module by checkpoint_segments , parameters and state_dict are unchanged'''
+    #checkpoint_report switches it off to measure the difference
+    enabled = True
+
+    def forward( self , x ):
+        forward = super( CheckpointedModule , self ).forward
+        if not ( CheckpointedModule.enabled and torch.is_grad_enabled() ):
+            return forward( x )
+        recomputation = [ False ]
+        def run( x ):
+            if not recomputation[0]:
+                recomputation[0] = True
+                return forward( x )
+            bns = [ m for m in self.modules() if isinstance( m , torch.nn.modules.batchnorm._BatchNorm ) and m.training and m.track_running_stats ]
+            stats = [ ( m.running_mean.clone() , m.running_var.clone() , m.num_batches_tracked.clone() ) for m in bns ]
+            #the recomputation may be stopped early by an exception once it has what the backward needs
+            try:
+                return forward( x )
+            finally:
+                for m , ( mean , var , num ) in zip( bns , stats ):
+                    m.running_mean.copy_( mean )
+                    m.running_var.copy_( var )
+                    m.num_batches_tracked.copy_( num )
+        return _checkpoint( run , x , use_reentrant = False )
+
+_checkpointed_classes = {}
+
+def checkpoint_segments( net , names ):
+    '''
+    checkpoints the sub-modules of net named in names ( e.g. ['layer2','layer3','d4'] or single blocks 'layer3.0' ) ,
+    they must take a single tensor
+    '''
+    for name in names:
+        m = net.get_submodule( name )
+        cls = type( m )
+        if isinstance( m , CheckpointedModule ):
+            continue
+        if cls not in _checkpointed_classes:
+            _checkpointed_classes[cls] = type( 'Checkpointed' + cls.__name__ , ( CheckpointedModule , cls ) , {} )
+        m.__class__ = _checkpointed_classes[cls]
+    return net
+
+def checkpoint_report( net , x , num_iter = 3 ):
+    '''
+    time and peak gpu memory ( None on cpu ) of a forward and backward on x without and with the checkpointing ,
+    in eval mode so the weights and batch norm statistics do not change
+    '''
+    training = net.training
+    net.eval()
+    report = {}
+    for enabled in [ False , True ]:
+        CheckpointedModule.enabled = enabled
+        if x.is_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        t = time.time()
+        for i in range( num_iter ):
+            results = net( x )
+            sum( v.float().sum() for v in results.values() ).backward()
+            del results
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        key = 'checkpointed' if enabled else 'eager'
+        report[key + '_step_time'] = ( time.time() - t ) / num_iter
+        report[key + '_peak_memory'] = torch.cuda.max_memory_allocated() / 2**20 if x.is_cuda else None
+    CheckpointedModule.enabled = True
+    net.zero_grad()
+    net.train( training )
+    return report
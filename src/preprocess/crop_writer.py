@@ -0,0 +1,100 @@
+'''
+Buffered writer of the single cell crops of an image.
+
+All crops of an image are collected with add() and written by write() in one go : the crop folder is created once ,
+every channel is encoded with the chosen codec and the crop metadata goes to the manifest with a single write.
+'''
+
+import numpy as np
+import cv2
+import os
+import shutil
+
+colors = ['red','green','blue','yellow']
+
+'''
+ARGUMENTS:
+savepath: directory to save the crops to , one sub-directory ( or one .npz ) per image
+codec: 'png' , 'jpg' or 'tif' write one file per channel per crop ( savepath/Id/{crop}_{color}.{codec} ) ,
+       'npz' writes all crops of an image as one (N,cropsize,cropsize,4) array with their centers and areas in savepath/Id.npz
+compression: png compression level ( 0 is uncompressed , 9 smallest ) , jpg quality , tif 0 for raw and >0 for lzw ,
+             npz 0 for np.savez and >0 for np.savez_compressed. None uses default_compression of the codec
+manifest: csv file the Id,crop,x,y,area of every written crop are appended to , None for no manifest
+header: write the csv header if the manifest is empty
+'''
+
+default_compression = { 'png' : 1 , 'jpg' : 95 , 'tif' : 0 , 'npz' : 0 }
+
+class CropWriter():
+    def __init__( self , savepath , codec = 'png' , compression = None , manifest = None , header = True ):
+        assert codec in ['png','jpg','tif','npz']
+        if compression is None:
+            compression = default_compression[codec]
+        self.savepath = savepath
+        self.codec = codec
+        self.compression = compression
+        if codec == 'png':
+            self.params = [ cv2.IMWRITE_PNG_COMPRESSION , compression ]
+        elif codec == 'jpg':
+            self.params = [ cv2.IMWRITE_JPEG_QUALITY , compression ]
+        elif codec == 'tif':
+            self.params = [ cv2.IMWRITE_TIFF_COMPRESSION , 5 if compression > 0 else 1 ]
+        os.makedirs( savepath , exist_ok = True )
+
+        self.manifest_fp = None
+        if manifest is not None:
+            self.manifest_fp = open( manifest , 'a' )
+            if header and self.manifest_fp.tell() == 0:
+                self.manifest_fp.write( 'Id,crop,x,y,area\n' )
+                self.manifest_fp.flush()
+        self.crops = []
+        self.meta = []
+
+    def add( self , crop , x , y , area = 0 ):
+        '''crop: (cropsize,cropsize,4) array , x , y: crop center , area: nucleus area'''
+        self.crops.append( crop )
+        self.meta.append( ( x , y , area ) )
+
+    def discard( self ):
+        self.crops = []
+        self.meta = []
+
+    def write( self , imagename ):
+        '''
+        writes the buffered crops as the crops of imagename and returns their number.
+        the output only appears under its final name once it is complete.
+        '''
+        n = len( self.crops )
+        if n == 0:
+            return 0
+        if self.codec == 'npz':
+            meta = np.array( self.meta , np.int64 ).reshape( -1 , 3 )
+            fname = os.path.join( self.savepath , imagename + '.npz' )
+            savez = np.savez_compressed if self.compression > 0 else np.savez
+            with open( fname + '.tmp' , 'wb' ) as f:
+                savez( f , crops = np.stack( self.crops , 0 ) , centers = meta[:,:2].astype( np.int32 ) , areas = meta[:,2].astype( np.int32 ) )
+            os.replace( fname + '.tmp' , fname )
+        else:
+            outfolder = os.path.join( self.savepath , imagename )
+            #left over by an interrupted run
+            if os.path.exists( outfolder + '.tmp' ):
+                shutil.rmtree( outfolder + '.tmp' )
+            os.mkdir( outfolder + '.tmp' )
+            for i , crop in enumerate( self.crops ):
+                for color_idx , color in enumerate( colors ):
+                    ok , buf = cv2.imencode( '.' + self.codec , np.ascontiguousarray( crop[:,:,color_idx] ) , self.params )
+                    buf.tofile( '{}.tmp/{}_{}.{}'.format( outfolder , i , color , self.codec ) )
+            if os.path.exists( outfolder ):
+                shutil.rmtree( outfolder )
+            os.rename( outfolder + '.tmp' , outfolder )
+
+        if self.manifest_fp is not None:
+            self.manifest_fp.write( ''.join( '{},{},{},{},{}\n'.format( imagename , i , x , y , area ) for i , ( x , y , area ) in enumerate( self.meta ) ) )
+            self.manifest_fp.flush()
+        self.discard()
+        return n
+
+    def close( self ):
+        if self.manifest_fp is not None:
+            self.manifest_fp.close()
+            self.manifest_fp = None
@@ -17,7 +17,8 @@ if __name__ == '__main__':
 
     df = pd.read_csv( args.csvfile , index_col = 0 )
 
-    a = os.listdir( args.searchdir )
+    #crops are either a directory per image or a packed .npz per image
+    a = set( os.path.splitext( x )[0] for x in os.listdir( args.searchdir ) if not x.endswith('.tmp') )
 
     for idx , v in tqdm(df.iterrows()):
         if idx not in a:
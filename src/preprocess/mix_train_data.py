@@ -1,28 +1,101 @@
 import pandas as pd
 import numpy as np
+import argparse
 
-def mix(mix_class,out_csv_fname):
-    original_train_df = pd.read_csv( '../../data/train.csv' , index_col = 0 )
-    original_train_df['Directory'] = '/home/wtw/kaggle/human_protein/data/train'
-    original_train_df['ImageFormat'] = 'png'
-    external_train_df = pd.read_csv( '../../data/external/HPAv18RBGY_wodpl.csv' , index_col = 0 )
-    external_train_df['Directory'] = '/home/wtw/kaggle/human_protein/data/external/HPAv18_images_512x512'
-    external_train_df['ImageFormat'] = 'jpg'
+num_classes = 28
+lt_1000 = [8,9,10,12,13,15,16,17,18,20,22,24,26,27]#samples less than 1000
 
-    external_train_df.Target = external_train_df.Target.apply( lambda x : np.array( x.split(' ') , np.uint8 ) )
-    print( external_train_df.Target.tail() )
+#name -> selection of the external rows added to the original train set , see select
+variants = {
+    'train_mix1' : { 'any_of' : lt_1000 },
+    'train_mix2' : { 'any_of' : [5,6,9,10,13,15,16,17,18,19,20,21,22,24,25,26,27] + lt_1000 },#recall lower than 60%
+    'train_mix3' : { 'any_of' : [6,10,13,15,16,17,18,19,20,21,22,27] + lt_1000 },#f1 lower than 60%
+}
 
-    #t = external_train_df.loc[ external_train_df == np.array( [0] ) ]
-    print(  external_train_df.Target.apply( lambda x : any( map( lambda y : y in mix_class , x  )) ).tail()  )  
-    filter_external_train_df = external_train_df.loc[ external_train_df.Target.apply( lambda x : any( map( lambda y : y in mix_class , x  )) ) ] # lower than 1000 samples numbers
-    filter_external_train_df.Target = filter_external_train_df.Target.apply( lambda x :  ' '.join( list(map( str , x )) )  )
-    print( filter_external_train_df.Target.head() )
+'''
+Parse the space separated Target strings of a dataframe at once:
 
-    mix_df = original_train_df.append( filter_external_train_df )
-    mix_df.to_csv( out_csv_fname )
+returns the (N,num_classes) bool multi-hot matrix
+'''
 
-lt_1000 = [8,9,10,12,13,15,16,17,18,20,22,24,26,27]
-mix(  lt_1000 ,  '../../data/train_mix1.csv')#samples less than 1000
-mix(  [5,6,9,10,13,15,16,17,18,19,20,21,22,24,25,26,27] + lt_1000 ,  '../../data/train_mix2.csv')#recall lower than 60%
-mix(  [6,10,13,15,16,17,18,19,20,21,22,27] + lt_1000 ,  '../../data/train_mix3.csv')#f1 lower than 60%
+def parse_targets( targets ):
+    targets = targets.astype( str ).str.split().str.join( ' ' )
+    lengths = targets.str.count( ' ' ).values + 1
+    labels = np.array( ' '.join( targets.values ).split() , np.int64 )
+    multi_hot = np.zeros( ( len( targets ) , num_classes ) , bool )
+    multi_hot[ np.repeat( np.arange( len( targets ) ) , lengths ) , labels ] = True
+    return multi_hot
 
+'''
+Rows of a multi-hot matrix to keep:
+
+ARGUMENTS:
+multi_hot: (N,num_classes) bool matrix
+any_of: keep the rows with at least one of these classes , None for all classes
+cap: if set , keep at most cap random rows per class of any_of ( a row is kept if one of its classes is still under the cap )
+seed: seed of the random order used by cap
+
+returns the (N,) bool mask
+'''
+
+def select( multi_hot , any_of = None , cap = None , seed = 0 ):
+    classes = np.arange( num_classes ) if any_of is None else np.unique( any_of )
+    hits = multi_hot[:,classes]
+    if cap is None:
+        return hits.any( 1 )
+    order = np.random.RandomState( seed ).permutation( len( hits ) )
+    #rank of every row among the rows of the same class , in the random order
+    ranks = np.empty_like( hits , np.int64 )
+    ranks[order] = np.cumsum( hits[order] , 0 )
+    return ( hits & ( ranks <= cap ) ).any( 1 )
+
+'''
+Read a source csv and tag every row with the directory and format of its images , unless the csv already has them
+'''
+
+def load_source( csv_fname , directory , image_format ):
+    df = pd.read_csv( csv_fname , index_col = 0 )
+    if 'Directory' not in df:
+        df['Directory'] = directory
+    if 'ImageFormat' not in df:
+        df['ImageFormat'] = image_format
+    df['Directory'] = df['Directory'].fillna( directory )
+    df['ImageFormat'] = df['ImageFormat'].fillna( image_format )
+    #the same image listed twice
+    return df[ ~df.index.duplicated( keep = 'first' ) ]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    #directories are written as given , relative paths are resolved from where the training runs ( src/ )
+    parser.add_argument( '--train_csv' , default = '../../data/train.csv' )
+    parser.add_argument( '--train_dir' , default = '../data/train' )
+    parser.add_argument( '--train_format' , default = 'png' )
+    parser.add_argument( '--external_csv' , default = '../../data/external/HPAv18RBGY_wodpl.csv' )
+    parser.add_argument( '--external_dir' , default = '../data/external/HPAv18_images_512x512' )
+    parser.add_argument( '--external_format' , default = 'jpg' )
+    parser.add_argument( '--outdir' , default = '../../data' )
+    parser.add_argument( '--variants' , nargs = '+' , default = list( variants.keys() ) )
+    parser.add_argument( '--any_of' , type = int , nargs = '+' , default = None , help = 'build only one mix , named --name , from these classes' )
+    parser.add_argument( '--name' , default = 'train_mix_custom' )
+    parser.add_argument( '--cap' , type = int , default = None , help = 'max number of external rows per selected class' )
+    parser.add_argument( '--seed' , type = int , default = 0 )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.any_of is not None:
+        variants[args.name] = { 'any_of' : args.any_of }
+        args.variants = [ args.name ]
+    original_train_df = load_source( args.train_csv , args.train_dir , args.train_format )
+    external_train_df = load_source( args.external_csv , args.external_dir , args.external_format )
+    #external images already in the original train set
+    external_train_df = external_train_df[ ~external_train_df.index.isin( original_train_df.index ) ]
+
+    multi_hot = parse_targets( external_train_df.Target )
+    print( '{} original , {} external rows'.format( len( original_train_df ) , len( external_train_df ) ) )
+    for name in args.variants:
+        v = variants[name]
+        mask = select( multi_hot , v.get( 'any_of' ) , v.get( 'cap' , args.cap ) , args.seed )
+        mix_df = pd.concat( [ original_train_df , external_train_df[mask] ] )
+        mix_df.to_csv( '{}/{}.csv'.format( args.outdir , name ) )
+        print( '{} : {} external rows added'.format( name , mask.sum() ) )
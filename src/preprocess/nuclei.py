@@ -0,0 +1,33 @@
+'''
+Per-nucleus measurements shared by the single cell crop scripts.
+'''
+
+import numpy as np
+from scipy.ndimage import center_of_mass, find_objects
+
+'''
+Given a labeled nuclei image ( 0 is background ), measure all nuclei in one pass over the image:
+
+ARGUMENTS:
+labeled_nuclei: integer label image
+min_nuc_size: nuclei with an area not larger than this are dropped
+
+RETURNS:
+labels: label of every kept nucleus , in increasing order
+centers: (N,2) int array of the x,y centers of mass
+areas: (N,) number of pixels of every nucleus
+bboxes: (N,4) bounding boxes as y0,x0,y1,x1 ( y1,x1 exclusive )
+'''
+
+def find_nuclei( labeled_nuclei , min_nuc_size ):
+    areas = np.bincount( labeled_nuclei.ravel() )
+    labels = np.nonzero( areas > min_nuc_size )[0]
+    labels = labels[ labels > 0 ]
+
+    centers = np.array( center_of_mass( labeled_nuclei > 0 , labeled_nuclei , labels ) , np.float64 ).reshape( -1 , 2 )
+    #center_of_mass gives y,x
+    centers = centers[:,::-1].astype( np.int64 )
+
+    objects = find_objects( labeled_nuclei )
+    bboxes = np.array( [ [ objects[i-1][0].start , objects[i-1][1].start , objects[i-1][0].stop , objects[i-1][1].stop ] for i in labels ] , np.int64 ).reshape( -1 , 4 )
+    return labels , centers , areas[labels] , bboxes
@@ -19,11 +19,17 @@ from skimage.filters import gaussian
 from skimage.measure import label
 from skimage.segmentation import clear_border
 from skimage.morphology import remove_small_objects, remove_small_holes
-from scipy.ndimage.measurements import center_of_mass
+from nuclei import find_nuclei
+from segment_engine import segment_nuclei, TorchNucleiSegmenter
+from crop_writer import CropWriter
 import pandas as pd
 import cv2
 from tqdm import tqdm
 import multiprocessing
+import shutil
+import json
+import glob
+from time import time
 
 from copy import deepcopy
 import warnings
@@ -37,15 +43,19 @@ ARGUMENTS:
 imagepath: full path of the image
 foldername: name of the folder image is in
 imagename: name of the jpeg file
-savepath: directory to save single cell crops to (will save in a subdirectory named after the folder)
-outfile: file to write coordinates of cell centers to (for debugging purposes)
+writer: CropWriter the crops are written with ( as savepath/imagename/{crop}_{color}.{codec} or savepath/imagename.npz )
 scale: scale to downsize original images by
 cropsize: size of square crops (in pixels on the rescaled image) to extract
+centers_only: do not write any crop , only return the nucleus centers ( the MIL dataset can then crop on the fly )
+
+returns the list of (x,y) nucleus centers on the rescaled image
 '''
 
-error_fp = open('./error_files.txt','w')
+#per worker logs , opened by init_worker
+error_fp = None
+metrics_fp = None
 
-def find_centers_and_crop (imagepath,  imagename, savepath, outfile, scale=4, cropsize=128 , image_format = 'jpg'):
+def load_image( imagepath , imagename , scale = 4 , image_format = 'jpg' ):
     # Get the image and resize
     #print( '{}/{}_{}.jpg'.format(imagepath , imagename, 'red' ) )
     imgs = [ cv2.imread('{}/{}_{}.{}'.format( imagepath , imagename, color , image_format )  , cv2.IMREAD_GRAYSCALE)   for color in ['red','green','blue','yellow']  ]
@@ -59,137 +69,259 @@ def find_centers_and_crop (imagepath,  imagename, savepath, outfile, scale=4, cr
         image_shape = tuple(ti//scale for ti in image_shape)
         #print( color_image.dtype )
         color_image = cv2.resize(color_image, image_shape , interpolation = cv2.INTER_LANCZOS4 )
-    
+    return color_image
 
-    # Split the image into channels
-    microtubules = color_image[:, :, 0]
-    antibody = color_image[:, :, 1]
-    nuclei = deepcopy( color_image[:, :, 2] )
-    nuclei = nuclei.astype(np.float64)/255
-    yellow_img = color_image[:,:,3]
+def find_centers_and_crop (imagepath,  imagename, writer, scale=4, cropsize=128 , image_format = 'jpg' , centers_only = False):
+    color_image = load_image( imagepath , imagename , scale , image_format )
 
     # Segment the nuclear channel and get the nuclei
-    min_nuc_size = 100.0
-
     try:
-        val = threshold_otsu(nuclei)
-        smoothed_nuclei = gaussian(nuclei, sigma=5.0)
-        binary_nuclei = smoothed_nuclei > val
-        binary_nuclei = remove_small_holes(binary_nuclei, min_size=300)
-        labeled_nuclei = label(binary_nuclei)
-        #labeled_nuclei = clear_border(labeled_nuclei)
-        labeled_nuclei = remove_small_objects(labeled_nuclei, min_size=min_nuc_size)
+        labeled_nuclei = segment_nuclei( color_image[:, :, 2] )
     except Exception as e:
-        print(e)
-        error_fp.write(imagename+'\n')
-        error_fp.flush()
-        return
+        #logged by run_task , the image is not marked as done
+        raise RuntimeError( 'segmentation failed: {}'.format( e ) )
+    return crop_nuclei( color_image , labeled_nuclei , imagename , writer , cropsize , centers_only )
+
+'''
+Crop around every nucleus of an already segmented image , same outputs as find_centers_and_crop
+'''
+
+def crop_nuclei( color_image , labeled_nuclei , imagename , writer , cropsize = 128 , centers_only = False ):
+    image_shape = color_image.shape[:2]
+    min_nuc_size = 100.0
 
     # Iterate through each nuclei and get their centers (if the object is valid), and save to directory
     #print( np.max( labeled_nuclei ) )
-    cnt = 0 
-    for i in range(1, np.max(labeled_nuclei) + 1 ):#0 means background
-        current_nuc = labeled_nuclei == i
-        if np.sum(current_nuc) > min_nuc_size:
-            y, x = center_of_mass(current_nuc)
-            x = np.int(x)
-            y = np.int(y)
-
-            c1 = y - cropsize // 2
-            c2 = y + cropsize // 2
-            c3 = x - cropsize // 2
-            c4 = x + cropsize // 2
-
-            cc1 = max( c1 , 0 )
-            cc2 = min( c2 , image_shape[0] )
-            cc3 = max( c3 , 0 )
-            cc4 = min( c4 , image_shape[1] )
-
-            d1 = cc1 - c1
-            d2 = c2 - cc2
-            d3 = cc3 - c3
-            d4 = c4 - cc4
-            #else:
-
-            img_crop = color_image[cc1:cc2,cc3:cc4]
-            if c1 < 0 or c3 < 0 or c2 > image_shape[0] or c4 > image_shape[1]:
-                img_crop = np.pad(  img_crop , ((d1,d2) , (d3,d4) , (0,0) ), mode = 'constant' , constant_values = 0 )
-
-            #folder_suffix = imagename.rsplit("_", 4)[0]
-            outfolder = savepath + imagename #+ foldername + "_" + folder_suffix
-            #outimagename = imagename.rsplit("_", 3)[0] + "_" + str(i)
-            outimagename = str(cnt)
-            cnt += 1
-
-            if not os.path.exists(outfolder):
-                os.mkdir(outfolder)
-
-            for color_idx, color in enumerate(['red','green','blue','yellow']):
-                Image.fromarray( img_crop[:,:,color_idx] ).save(outfolder + "/" + outimagename + "_{}.png".format(color) )
-
-            '''
-            output = open(outfile, "a")
-            #output.write(foldername + "_" + folder_suffix + "/" + outimagename)
-            output.write(imagename+'/'+outimagename)
-            output.write("\t")
-            output.write(str(x))
-            output.write("\t")
-            output.write(str(y))
-            output.write("\n")
-            output.close()
-            '''
-    return
-
-def run_task( df ):
-    for Id ,v  in df.iterrows() :
-        imagepath =  Id
-        find_centers_and_crop(filepath, Id, outpath, outfile , scale = scale ,  image_format = image_format)
-    return
+    labels , centers , areas , bboxes = find_nuclei( labeled_nuclei , min_nuc_size )
+    if centers_only:
+        return centers
+    for (x,y) , area in zip( centers , areas ):
+        c1 = y - cropsize // 2
+        c2 = y + cropsize // 2
+        c3 = x - cropsize // 2
+        c4 = x + cropsize // 2
+
+        cc1 = max( c1 , 0 )
+        cc2 = min( c2 , image_shape[0] )
+        cc3 = max( c3 , 0 )
+        cc4 = min( c4 , image_shape[1] )
+
+        d1 = cc1 - c1
+        d2 = c2 - cc2
+        d3 = cc3 - c3
+        d4 = c4 - cc4
+        #else:
+
+        img_crop = color_image[cc1:cc2,cc3:cc4]
+        if c1 < 0 or c3 < 0 or c2 > image_shape[0] or c4 > image_shape[1]:
+            img_crop = np.pad(  img_crop , ((d1,d2) , (d3,d4) , (0,0) ), mode = 'constant' , constant_values = 0 )
+        writer.add( img_crop , x , y , area )
+
+    writer.write( imagename )
+    return centers
+
+def init_worker( args ):
+    global task_args , error_fp , metrics_fp , segmenter , writer
+    task_args = args
+    #every worker has its own logs , merged by the main process at the end
+    error_fp = open( '{}/errors.{}.txt'.format( args.log_dir , os.getpid() ) , 'a' )
+    metrics_fp = open( '{}/metrics.{}.csv'.format( args.log_dir , os.getpid() ) , 'a' )
+    #crop metadata of the worker , merged into outpath/manifest.csv
+    writer = CropWriter( args.outpath , codec = args.codec , compression = args.compression , manifest = '{}/manifest.{}.csv'.format( args.log_dir , os.getpid() ) , header = False )
+    segmenter = None
+    if args.engine == 'torch':
+        segmenter = TorchNucleiSegmenter( num_threads = args.threads )
+
+def log_error( Id , e ):
+    error_fp.write( '{}\t{}\n'.format( Id , repr( e ) ) )
+    error_fp.flush()
+
+def run_task( Ids ):
+    args = task_args
+    results = []
+    if segmenter is None:
+        for Id in Ids:
+            t = time()
+            try:
+                centers = find_centers_and_crop( args.filepath , Id , writer , scale = args.scale , image_format = args.image_format , centers_only = args.centers_only )
+            except Exception as e:
+                writer.discard()
+                #a broken image must not take the whole pool down
+                log_error( Id , e )
+                results.append( ( Id , False , [] ) )
+                continue
+            metrics_fp.write( '{},{},{:.4f}\n'.format( Id , len( centers ) , time() - t ) )
+            results.append( ( Id , True , [ (x,y) for x,y in centers ] ) )
+        metrics_fp.flush()
+        return results
+
+    #torch engine : load the whole batch , segment it at once , then crop image by image
+    t = time()
+    images = {}
+    for Id in Ids:
+        try:
+            images[Id] = load_image( args.filepath , Id , args.scale , args.image_format )
+        except Exception as e:
+            log_error( Id , e )
+            results.append( ( Id , False , [] ) )
+    try:
+        labeled = dict( zip( images.keys() , segmenter( [ img[:,:,2] for img in images.values() ] ) ) )
+    except Exception as e:
+        #one bad image fails the whole batch , segment them one by one to find it
+        labeled = {}
+        for Id , img in images.items():
+            try:
+                labeled[Id] = segmenter( [ img[:,:,2] ] )[0]
+            except Exception as e:
+                log_error( Id , RuntimeError( 'segmentation failed: {}'.format( e ) ) )
+                results.append( ( Id , False , [] ) )
+    for Id in labeled:
+        try:
+            centers = crop_nuclei( images[Id] , labeled[Id] , Id , writer , centers_only = args.centers_only )
+        except Exception as e:
+            writer.discard()
+            log_error( Id , e )
+            results.append( ( Id , False , [] ) )
+            continue
+        results.append( ( Id , True , [ (x,y) for x,y in centers ] ) )
+    #the batch time is shared by its images
+    seconds = ( time() - t ) / max( 1 , len( Ids ) )
+    for Id , ok , centers in results:
+        if ok:
+            metrics_fp.write( '{},{},{:.4f}\n'.format( Id , len( centers ) , seconds ) )
+    metrics_fp.flush()
+    return results
+
+def merge_logs( pattern , out_fname , header = None ):
+    fnames = sorted( glob.glob( pattern ) )
+    new_file = not os.path.exists( out_fname )
+    with open( out_fname , 'a' ) as out_fp:
+        if new_file and header is not None:
+            out_fp.write( header )
+        for fname in fnames:
+            with open( fname ) as fp:
+                shutil.copyfileobj( fp , out_fp )
+            os.remove( fname )
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument( '--csvpath' , default =  '../../data/external/HPAv18RBGY_wodpl.csv')
     parser.add_argument( '--filepath' , default =  '../../data/external/HPAv18_images')
     parser.add_argument( '--outpath' , default =  "../../data/external/HPAv18_images_single_cell_crop/")
-    parser.add_argument( '--outfile' , default =  "../../data/external/single_cell_crop_centers.txt")
+    parser.add_argument( '--outfile' , default =  "../../data/external/single_cell_crop_centers.csv" , help = 'csv of the nucleus centers , columns Id,x,y in pixels of the image downscaled by --scale' )
+    parser.add_argument( '--error_file' , default =  "./error_files.txt")
     parser.add_argument( '--image_format' , default = 'jpg' )
     parser.add_argument( '--scale' ,type = int ,default = 4 )
+    parser.add_argument( '--codec' , default = 'png' , choices = ['png','jpg','tif','npz'] , help = 'npz writes one file of all crops per image instead of 4 files per crop' )
+    parser.add_argument( '--compression' , type = int , default = None , help = 'png level ( 0 is uncompressed ) or jpg quality , see crop_writer.py' )
+    parser.add_argument( '--pack' , action = 'store_true' , help = 'same as --codec npz' )
+    parser.add_argument( '--centers_only' , action = 'store_true' , help = 'only write the nucleus center table to outfile , no crops' )
+    parser.add_argument( '--processes' , type = int , default = os.cpu_count() )
+    parser.add_argument( '--engine' , default = 'skimage' , choices = ['skimage','torch'] , help = 'torch segments batch_size images at once , see segment_engine.py' )
+    parser.add_argument( '--batch_size' , type = int , default = 16 )
+    parser.add_argument( '--threads' , type = int , default = 1 , help = 'torch threads of every process' )
+    parser.add_argument( '--overwrite' , action = 'store_true' , help = 'start from scratch instead of skipping the images already done' )
     return parser.parse_args()
 
 if __name__ == "__main__":
     '''Loop to call the cell crop segmentation on all folders in a directory. If you used the download_hpa.py file
-    to obtain the HPA images, they will already be in the format required by this script.'''
-
-    args = parse_args()
-    csvpath = args.csvpath
-    filepath = args.filepath
-    outpath = args.outpath
-    outfile = args.outfile
-    image_format = args.image_format
-    scale = args.scale
+    to obtain the HPA images, they will already be in the format required by this script.
 
+    Images already listed in outpath/done.txt are skipped , so an interrupted run can simply be restarted.'''
 
-
-    # Creates output folder if necessary
-    if not os.path.exists(outpath):
-        os.mkdir(outpath)
+    args = parse_args()
+    if args.pack:
+        args.codec = 'npz'
+    if args.overwrite and os.path.exists( args.outpath ):
+        shutil.rmtree( args.outpath )
+        for fname in [ args.outfile , args.outfile + '.json' ]:
+            if os.path.exists( fname ):
+                os.remove( fname )
+    args.log_dir = os.path.join( args.outpath , 'logs' )
+    os.makedirs( args.log_dir , exist_ok = True )
+    done_fname = os.path.join( args.outpath , 'done.txt' )
+
+    done = set()
+    if os.path.exists( done_fname ):
+        with open( done_fname ) as fp:
+            done = set( fp.read().split() )
+    #logs of workers killed in the previous run
+    merge_logs( '{}/errors.*.txt'.format( args.log_dir ) , args.error_file )
+    merge_logs( '{}/metrics.*.csv'.format( args.log_dir ) , os.path.join( args.outpath , 'metrics.csv' ) , header = 'Id,num_nuclei,seconds\n' )
+    merge_logs( '{}/manifest.*.csv'.format( args.log_dir ) , os.path.join( args.outpath , 'manifest.csv' ) , header = 'Id,crop,x,y,area\n' )
+
+    if os.path.exists( args.outfile ):
+        with open( args.outfile ) as fp:
+            header = fp.readline().strip()
+        if header != 'Id,x,y':
+            #the former script wrote Id/crop<tab>x<tab>y lines without header
+            raise ValueError( '{} is not an Id,x,y csv ( first line {!r} ) , probably written by the former tab separated version , use --overwrite or another --outfile'.format( args.outfile , header ) )
+
+    #the centers are in pixels of the image downscaled by --scale , recorded in outfile.json for the MIL dataset
+    #( data['mil_crop_scale'] ) , a restarted run must use the same scale
+    scale_fname = args.outfile + '.json'
+    if os.path.exists( scale_fname ):
+        with open( scale_fname ) as fp:
+            recorded_scale = json.load( fp )['scale']
+        if recorded_scale != args.scale:
+            raise ValueError( '{} holds centers at --scale {} , not {} , use --overwrite to start again'.format( args.outfile , recorded_scale , args.scale ) )
     else:
-        os.system( 'rm -rf {}'.format( outpath ) )
-        os.mkdir(outpath)
+        if os.path.exists( args.outfile ):
+            warnings.warn( '{} has no recorded scale , assuming --scale {}'.format( args.outfile , args.scale ) )
+        with open( scale_fname , 'w' ) as fp:
+            json.dump( { 'scale' : args.scale } , fp )
+
+    #centers of images not marked as done may be partially written , drop them
+    if os.path.exists( args.outfile ):
+        centers_df = pd.read_csv( args.outfile )
+        centers_df = centers_df[ centers_df.Id.isin( done ) ]
+        centers_df.to_csv( args.outfile + '.tmp' , index = False )
+        os.replace( args.outfile + '.tmp' , args.outfile )
+    else:
+        with open( args.outfile , 'w' ) as fp:
+            fp.write('Id,x,y\n')
 
-    if os.path.exists( outfile ):
-        os.remove( outfile )
+    #crops of images not marked as done are written again , drop all their former manifest rows so a redone image
+    #yielding fewer crops leaves no stale row behind
+    manifest_fname = os.path.join( args.outpath , 'manifest.csv' )
+    if os.path.exists( manifest_fname ):
+        manifest = pd.read_csv( manifest_fname )
+        manifest[ manifest.Id.isin( done ) ].to_csv( manifest_fname + '.tmp' , index = False )
+        os.replace( manifest_fname + '.tmp' , manifest_fname )
 
     # Loop over all folders in the input folder and extract single cell crops for all images
     # Writes single cell crops to sub-directories in the outpath folder,
     # named identical to the sub-directories in the input folder
 
-    df = pd.read_csv( csvpath  , index_col = 0 )
-    SPLIT_NUM = 10000
-    df_list = np.array_split( df , SPLIT_NUM )
-
-    pool = multiprocessing.pool.Pool( 16 )
-
-    list( tqdm( pool.imap( run_task , df_list ) ,  total = SPLIT_NUM) )
-    error_fp.close()
-
+    df = pd.read_csv( args.csvpath  , index_col = 0 )
+    todo = [ Id for Id in df.index if Id not in done ]
+    print( '{} images , {} already done'.format( len( df ) , len( df ) - len( todo ) ) )
+    batch_size = args.batch_size if args.engine == 'torch' else 1
+    tasks = [ todo[i:i+batch_size] for i in range( 0 , len( todo ) , batch_size ) ]
+    #big enough chunks to amortize the IPC , small enough to keep all workers busy until the end
+    chunksize = max( 1 , min( 64 , len( tasks ) // ( args.processes * 8 ) ) )
+
+    pool = multiprocessing.Pool( args.processes , initializer = init_worker , initargs = ( args , ) )
+    num_errors = 0
+    #nucleus centers of every image , in pixels of the rescaled image
+    with open( args.outfile , 'a' ) as out_fp , open( done_fname , 'a' ) as done_fp:
+        pbar = tqdm( total = len( todo ) )
+        for results in pool.imap_unordered( run_task , tasks , chunksize = chunksize ):
+            for Id , ok , centers in results:
+                if not ok:
+                    num_errors += 1
+                    continue
+                for x,y in centers:
+                    out_fp.write('{},{},{}\n'.format( Id , x , y ) )
+                out_fp.flush()
+                done_fp.write( Id + '\n' )
+                done_fp.flush()
+            pbar.update( len( results ) )
+        pbar.close()
+    pool.close()
+    pool.join()
+
+    merge_logs( '{}/errors.*.txt'.format( args.log_dir ) , args.error_file )
+    merge_logs( '{}/metrics.*.csv'.format( args.log_dir ) , os.path.join( args.outpath , 'metrics.csv' ) , header = 'Id,num_nuclei,seconds\n' )
+    merge_logs( '{}/manifest.*.csv'.format( args.log_dir ) , os.path.join( args.outpath , 'manifest.csv' ) , header = 'Id,crop,x,y,area\n' )
+    print( '{} images failed , see {}'.format( num_errors , args.error_file ) )
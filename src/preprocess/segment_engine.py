@@ -0,0 +1,265 @@
+'''
+Nucleus segmentation of the (downscaled) blue channel.
+
+segment_nuclei is the reference skimage pipeline used by the crop scripts : otsu threshold of the gaussian
+smoothed image , fill small holes , label , drop small objects.
+
+TorchNucleiSegmenter runs the same pipeline on a batch of images at once : the histogram otsu and the separable
+gaussian are done on torch tensors ( float32 , on cpu threads ) and only the connected components go through scipy ,
+with one label call for the whole batch.
+
+Run this file to compare both on real images and measure their throughput:
+    python segment_engine.py --csvpath ... --filepath ... --num_images 128 --batch_size 16
+or on generated images , without any data ( check_parity raises if the two disagree ):
+    python segment_engine.py --synthetic
+'''
+
+import numpy as np
+import torch
+from scipy import ndimage
+from skimage.filters import threshold_otsu
+from skimage.filters import gaussian
+from skimage.measure import label
+from skimage.morphology import remove_small_objects, remove_small_holes
+import argparse
+from time import time
+
+'''
+Reference segmentation of one nuclei channel:
+
+ARGUMENTS:
+nuclei: (H,W) uint8 image
+sigma: std of the gaussian smoothing
+min_hole_size: holes smaller than this are filled
+min_nuc_size: objects smaller than this are dropped
+
+returns the (H,W) label image , 0 is background
+'''
+
+def segment_nuclei( nuclei , sigma = 5.0 , min_hole_size = 300 , min_nuc_size = 100 ):
+    nuclei = nuclei.astype(np.float64)/255
+    val = threshold_otsu(nuclei)
+    smoothed_nuclei = gaussian(nuclei, sigma=sigma)
+    binary_nuclei = smoothed_nuclei > val
+    binary_nuclei = remove_small_holes(binary_nuclei, min_size=min_hole_size)
+    labeled_nuclei = label(binary_nuclei)
+    labeled_nuclei = remove_small_objects(labeled_nuclei, min_size=min_nuc_size)
+    return labeled_nuclei
+
+class TorchNucleiSegmenter():
+    '''
+    ARGUMENTS:
+    sigma , min_hole_size , min_nuc_size: same as segment_nuclei
+    truncate: the gaussian kernel is cut at truncate * sigma , like scipy
+    num_threads: torch threads , None keeps the torch default
+    '''
+    def __init__( self , sigma = 5.0 , min_hole_size = 300 , min_nuc_size = 100 , truncate = 4.0 , num_threads = None ):
+        self.min_hole_size = min_hole_size
+        self.min_nuc_size = min_nuc_size
+        if num_threads is not None:
+            torch.set_num_threads( num_threads )
+
+        radius = int( truncate * sigma + 0.5 )
+        x = np.arange( -radius , radius + 1 )
+        kernel = np.exp( -0.5 / sigma ** 2 * x ** 2 )
+        self.kernel = kernel / kernel.sum()
+        self.radius = radius
+        self.smooth_matrices = {}
+
+        #no connectivity between the images of a batch , 4 connected holes and 8 connected nuclei within an image
+        self.hole_structure = np.zeros( (3,3,3) , bool )
+        self.hole_structure[1] = ndimage.generate_binary_structure( 2 , 1 )
+        self.nuclei_structure = np.zeros( (3,3,3) , bool )
+        self.nuclei_structure[1] = True
+
+    def otsu( self , x ):
+        '''
+        x: (B,H,W) uint8 tensor
+        returns the (B,) float64 thresholds of x / 255 , identical to skimage threshold_otsu with 256 bins
+        '''
+        B = x.shape[0]
+        #uint8 histogram of every image , then regrouped into the 256 bins spanning [min,max] of that image
+        raw = torch.bincount( ( x.view( B , -1 ).long() + 256 * torch.arange( B ).view( B , 1 ) ).view( -1 ) , minlength = 256 * B ).view( B , 256 ).double()
+        values = torch.arange( 256 , dtype = torch.float64 ) / 255
+        present = raw > 0
+        first = torch.where( present , values , torch.full_like( raw , np.inf ) ).min( 1 )[0]
+        last = torch.where( present , values , torch.full_like( raw , -np.inf ) ).max( 1 )[0]
+        constant = first == last
+        last = torch.where( constant , first + 1 , last )
+
+        #same bin edges and bin assignment as np.histogram
+        step = ( last - first ) / 256
+        edges = torch.arange( 257 , dtype = torch.float64 ).view( 1 , -1 ) * step.view( B , 1 ) + first.view( B , 1 )
+        edges[:,-1] = last
+        idx = ( ( values.view( 1 , -1 ) - first.view( B , 1 ) ) * ( 256 / ( last - first ) ).view( B , 1 ) ).floor().long().clamp( 0 , 255 )
+        idx -= ( values.view( 1 , -1 ) < edges.gather( 1 , idx ) ).long()
+        idx = idx.clamp( 0 , 255 )
+        idx += ( ( values.view( 1 , -1 ) >= edges.gather( 1 , idx + 1 ) ) & ( idx != 255 ) ).long()
+        counts = torch.zeros_like( raw ).scatter_add_( 1 , idx , raw )
+        bin_centers = ( edges[:,:-1] + edges[:,1:] ) / 2
+
+        weight1 = counts.cumsum( 1 )
+        weight2 = counts.flip( 1 ).cumsum( 1 ).flip( 1 )
+        mean1 = ( counts * bin_centers ).cumsum( 1 ) / weight1
+        mean2 = ( counts * bin_centers ).flip( 1 ).cumsum( 1 ) / weight2.flip( 1 )
+        mean2 = mean2.flip( 1 )
+        variance12 = weight1[:,:-1] * weight2[:,1:] * ( mean1[:,:-1] - mean2[:,1:] ) ** 2
+        #nan where a class is empty , numpy argmax would stop on them
+        variance12[ torch.isnan( variance12 ) ] = -1
+        thresholds = bin_centers.gather( 1 , variance12.argmax( 1 , keepdim = True ) ).view( B )
+        return torch.where( constant , first , thresholds )
+
+    def smooth_matrix( self , n ):
+        '''
+        (n,n) banded matrix applying the 1d gaussian along an axis of length n , the out of range taps go to the
+        edge pixels like scipy 'nearest'
+        '''
+        if n not in self.smooth_matrices:
+            m = np.zeros( (n,n) , np.float64 )
+            rows = np.arange( n ).reshape( -1 , 1 )
+            cols = np.clip( rows + np.arange( -self.radius , self.radius + 1 ).reshape( 1 , -1 ) , 0 , n - 1 )
+            np.add.at( m , ( np.broadcast_to( rows , cols.shape ) , cols ) , np.broadcast_to( self.kernel , cols.shape ) )
+            self.smooth_matrices[n] = torch.from_numpy( m ).float()
+        return self.smooth_matrices[n]
+
+    def smooth( self , x ):
+        '''
+        x: (B,H,W) uint8 tensor
+        returns the (B,H,W) float32 gaussian smoothed x / 255
+        '''
+        B , H , W = x.shape
+        x = x.float().div_( 255 )
+        #separable gaussian as two matrix products , much faster on cpu than a conv with a long kernel
+        x = torch.matmul( x.view( B * H , W ) , self.smooth_matrix( W ).t() ).view( B , H , W )
+        return torch.matmul( self.smooth_matrix( H ) , x )
+
+    def cleanup( self , binary ):
+        '''
+        binary: (B,H,W) bool array
+        returns the (B,H,W) int32 label images , labels start at 1 in every image
+        '''
+        holes , _ = ndimage.label( ~binary , self.hole_structure )
+        small = np.bincount( holes.ravel() ) < self.min_hole_size
+        small[0] = False
+        binary |= np.take( small , holes )
+
+        labeled , num_labels = ndimage.label( binary , self.nuclei_structure )
+        #labels are numbered in raster order over the whole batch , so image i holds the labels after the last one of image i-1
+        last_labels = np.maximum.accumulate( labeled.reshape( len( labeled ) , -1 ).max( 1 ) )
+        image_of_label = np.searchsorted( last_labels , np.arange( num_labels + 1 ) )
+        offsets = np.concatenate( [ [0] , last_labels[:-1] ] )
+        #one lookup renumbers every image from 1 and drops the small objects , leaving gaps like remove_small_objects
+        table = np.arange( num_labels + 1 ) - offsets[ image_of_label ]
+        table[ np.bincount( labeled.ravel() ) < self.min_nuc_size ] = 0
+        table[0] = 0
+        return np.take( table.astype( labeled.dtype ) , labeled )
+
+    def __call__( self , nuclei_list ):
+        '''
+        nuclei_list: list of (H,W) uint8 images , images of different shapes are processed in separate batches
+        returns the list of label images , in the same order
+        '''
+        out = [ None ] * len( nuclei_list )
+        shapes = {}
+        for i , img in enumerate( nuclei_list ):
+            shapes.setdefault( img.shape , [] ).append( i )
+        for shape , indices in shapes.items():
+            x = torch.from_numpy( np.stack( [ nuclei_list[i] for i in indices ] , 0 ) )
+            thresholds = self.otsu( x )
+            binary = ( self.smooth( x ) > thresholds.view( -1 , 1 , 1 ) ).numpy()
+            labeled = self.cleanup( binary )
+            for i , img in zip( indices , labeled ):
+                out[i] = img
+        return out
+
+def synthetic_nuclei( num_images , shapes = [ (256,256) , (192,320) ] , seed = 0 ):
+    '''
+    generated blue channels : noisy background , elliptic nuclei of random size and brightness , some with a dark
+    hole , and specks smaller than min_nuc_size. the images alternate between shapes so batches get split too
+    returns a list of (H,W) uint8 images
+    '''
+    rng = np.random.RandomState( seed )
+    images = []
+    for i in range( num_images ):
+        h , w = shapes[ i % len( shapes ) ]
+        y , x = np.mgrid[:h,:w]
+        img = rng.normal( 20 , 6 , ( h , w ) )
+        for _ in range( rng.randint( 3 , 12 ) ):
+            cy , cx = rng.uniform( 0 , h ) , rng.uniform( 0 , w )
+            ry , rx = rng.uniform( 8 , 24 , 2 )
+            r2 = ( ( y - cy ) / ry ) ** 2 + ( ( x - cx ) / rx ) ** 2
+            img[ r2 < 1 ] += rng.uniform( 80 , 200 )
+            if rng.rand() < 0.3:
+                img[ r2 < 0.1 ] -= 60
+        for _ in range( rng.randint( 0 , 6 ) ):
+            cy , cx = rng.randint( 0 , h ) , rng.randint( 0 , w )
+            img[ cy:cy+3 , cx:cx+3 ] += 150
+        images.append( np.clip( img , 0 , 255 ).astype( np.uint8 ) )
+    return images
+
+def compare( reference , labeled ):
+    '''agreement of two lists of label images : foreground pixels , identical images and number of nuclei'''
+    return {
+        'pixel_agreement' : float( np.mean( [ np.mean( ( a > 0 ) == ( b > 0 ) ) for a , b in zip( reference , labeled ) ] ) ),
+        'exact' : float( np.mean( [ np.array_equal( a , b ) for a , b in zip( reference , labeled ) ] ) ),
+        'same_count' : float( np.mean( [ len( np.unique( a ) ) == len( np.unique( b ) ) for a , b in zip( reference , labeled ) ] ) ),
+    }
+
+def check_parity( num_images = 16 , batch_size = 8 , min_pixel_agreement = 0.999 , min_same_count = 1.0 , num_threads = None ):
+    '''
+    TorchNucleiSegmenter against segment_nuclei on synthetic_nuclei images , raises AssertionError when they disagree
+    returns the compare() metrics
+    '''
+    images = synthetic_nuclei( num_images )
+    reference = [ segment_nuclei( img ) for img in images ]
+    segmenter = TorchNucleiSegmenter( num_threads = num_threads )
+    labeled = []
+    for i in range( 0 , len( images ) , batch_size ):
+        labeled += segmenter( images[i:i+batch_size] )
+    metrics = compare( reference , labeled )
+    assert metrics['pixel_agreement'] >= min_pixel_agreement and metrics['same_count'] >= min_same_count , 'torch and skimage segmentations differ : {}'.format( metrics )
+    return metrics
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--csvpath' , default =  '../../data/external/HPAv18RBGY_wodpl.csv')
+    parser.add_argument( '--filepath' , default =  '../../data/external/HPAv18_images')
+    parser.add_argument( '--image_format' , default = 'jpg' )
+    parser.add_argument( '--scale' ,type = int ,default = 4 )
+    parser.add_argument( '--num_images' ,type = int ,default = 128 )
+    parser.add_argument( '--batch_size' ,type = int ,default = 16 )
+    parser.add_argument( '--threads' ,type = int ,default = None )
+    parser.add_argument( '--synthetic' , action = 'store_true' , help = 'parity check on generated images , no data needed' )
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    '''Parity check of TorchNucleiSegmenter against segment_nuclei and throughput of both.'''
+    import cv2
+    import pandas as pd
+    args = parse_args()
+    if args.synthetic:
+        print( check_parity( args.num_images , args.batch_size , num_threads = args.threads ) )
+        exit()
+    Ids = pd.read_csv( args.csvpath , index_col = 0 ).index[:args.num_images]
+    images = []
+    for Id in Ids:
+        img = cv2.imread('{}/{}_{}.{}'.format( args.filepath , Id , 'blue' , args.image_format ) , cv2.IMREAD_GRAYSCALE )
+        if args.scale != 1:
+            img = cv2.resize( img , ( img.shape[1] // args.scale , img.shape[0] // args.scale ) , interpolation = cv2.INTER_LANCZOS4 )
+        images.append( img )
+
+    t = time()
+    reference = [ segment_nuclei( img ) for img in images ]
+    t_reference = time() - t
+
+    segmenter = TorchNucleiSegmenter( num_threads = args.threads )
+    t = time()
+    labeled = []
+    for i in range( 0 , len( images ) , args.batch_size ):
+        labeled += segmenter( images[i:i+args.batch_size] )
+    t_torch = time() - t
+
+    metrics = compare( reference , labeled )
+    print( 'foreground pixel agreement {:.6f}'.format( metrics['pixel_agreement'] ) )
+    print( 'identical label images {:.4f} , same number of nuclei {:.4f}'.format( metrics['exact'] , metrics['same_count'] ) )
+    print( 'skimage {:.1f} images/s , torch {:.1f} images/s ( x{:.2f} )'.format( len( images ) / t_reference , len( images ) / t_torch , t_reference / t_torch ) )
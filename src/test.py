@@ -4,7 +4,8 @@ from dataset import *
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 import numpy as np
-from utils import load_model,aggregate_results,set_requires_grad
+from utils import load_model,aggregate_results,set_requires_grad,CompiledForward,compare_forward
+from checkpoint import Catalog
 from time import time
 import os
 import train_config as config
@@ -124,6 +125,9 @@ def main(config):
 
     net_kwargs = deepcopy( config.net )
     net_name = net_kwargs.pop('name')
+    compile_mode = net_kwargs.pop('compile')
+    #no backward at test time
+    net_kwargs.pop('checkpoint_segments')
 
     net = eval("models.{}".format(net_name))(**net_kwargs)
     net = nn.DataParallel( net )
@@ -132,11 +136,29 @@ def main(config):
     
 
 
-    load_dict = torch.load(config.test['model']) 
+    model_path = config.test['model']
+    catalog = Catalog( model_path if os.path.isdir( model_path ) else os.path.dirname( model_path ) )
+    if os.path.isdir( model_path ):
+        if config.test['select'] == 'last':
+            name = catalog.latest( content = 'full' )
+        else:
+            name = catalog.best( config.test['select'] , maximize = config.train['save_metric'][config.test['select']] , content = 'full' )
+        assert name is not None , 'no checkpoint in the catalog of {}'.format( model_path )
+        model_path = catalog.path( name )
+    #older runs have no catalog , their name is in the path
+    run_name = catalog.run if catalog.run is not None else model_path.split('/')[-3]
+
+    load_dict = torch.load(model_path) 
     #for k in load_dict['model']:
     #    print(k)
     net.load_state_dict( load_dict['model'] , strict = True )
-    print( 'Sucessfully load {} , epoch {}'.format(config.test['model'],load_dict['epoch']) )
+    print( 'Sucessfully load {} , epoch {}'.format(model_path,load_dict['epoch']) )
+
+    forward_fn = net
+    if compile_mode:
+        forward_fn = CompiledForward( net , compile_mode )
+        report = compare_forward( net , forward_fn , next( iter( val_dataloader ) )['img'][:,0].cuda() , backward = False )
+        print( '{} : max abs diff {:.2e} , eager step {:.4f}s , compiled step {:.4f}s'.format( forward_fn.mode , report['max_abs_diff'] , report['eager_step_time'] , report['compiled_step_time'] ) )
 
 
     net.eval()
@@ -148,23 +170,19 @@ def main(config):
 
             #print( type( batch['img'][0] ) )
             #TTA
-            if config.train['MIL']:
-                bag_sizes = [ len( v ) for v in batch['img'] ]
-                batch['img'] = torch.cat( batch['img'] , 0 )
-
             for k in batch:
                 if k in ['img']:
-                    batch[k] = batch[k].cuda(async=True)
+                    batch[k] = batch[k].cuda(non_blocking=True)
                     batch[k].requires_grad = False
 
             
             results_list = []
             for i in range( config.test['tta'] ):
-                results = net( batch['img'][:,i] )
+                results = forward_fn( batch['img'][:,i] )
                 for k in results:
                     results[k] = results[k].detach().cpu()
                 if config.train['MIL']:
-                    results = aggregate_results( results , bag_sizes , config.train['MIL_aggregate_fn'])
+                    results = aggregate_results( results , batch['bag_index'] , len( batch['offsets'] ) - 1 , config.train['MIL_aggregate'] )
                 results_list.append( results )
             
             batch_fc = [ x['fc'] for x in results_list ]
@@ -207,23 +225,19 @@ def main(config):
     with torch.no_grad():
         for step , batch in tqdm(enumerate( test_dataloader ) , total = len(test_dataloader) ):
 
-            if config.train['MIL']:
-                bag_sizes = [ len( v ) for v in batch['img'] ]
-                batch['img'] = torch.cat( batch['img'] , 0 )
-
             for k in batch:
                 if k in ['img']:
-                    batch[k] = batch[k].cuda(async=True)
+                    batch[k] = batch[k].cuda(non_blocking=True)
                     batch[k].requires_grad = False
 
             
             results_list = []
             for i in range( config.test['tta'] ):
-                results = net( batch['img'][:,i] )
+                results = forward_fn( batch['img'][:,i] )
                 for k in results:
                     results[k] = results[k].detach().cpu()
                 if config.train['MIL']:
-                    results = aggregate_results( results , bag_sizes , config.train['MIL_aggregate_fn'])
+                    results = aggregate_results( results , batch['bag_index'] , len( batch['offsets'] ) - 1 , config.train['MIL_aggregate'] )
                 results_list.append( results )
             
             batch_fc = [ x['fc'] for x in results_list ]
@@ -239,10 +253,10 @@ def main(config):
     th_train = fit_test( test_pred , label_fraction , config.net['num_classes'] )
     print( 'threshold train :\n' , th_train )
     th_lb = fit_test( test_pred , lb_prob , config.net['num_classes'])
-    save_pred( test_pred , th_train , '../submit/{}'.format( config.test['model'].split('/')[-3] + '_train.csv' ) )
-    save_pred( test_pred , th, '../submit/{}'.format( config.test['model'].split('/')[-3] + '_val.csv' ) )
-    save_pred( test_pred , th_lb , '../submit/{}'.format( config.test['model'].split('/')[-3] + '_lb_prob.csv' ) )
-    save_pred( test_pred , 0.5 , '../submit/{}'.format( config.test['model'].split('/')[-3] + '_05.csv' ) )
+    save_pred( test_pred , th_train , '../submit/{}'.format( run_name + '_train.csv' ) )
+    save_pred( test_pred , th, '../submit/{}'.format( run_name + '_val.csv' ) )
+    save_pred( test_pred , th_lb , '../submit/{}'.format( run_name + '_lb_prob.csv' ) )
+    save_pred( test_pred , 0.5 , '../submit/{}'.format( run_name + '_05.csv' ) )
     return test_pred
 
 if __name__ == '__main__' :
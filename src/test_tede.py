@@ -71,6 +71,8 @@ def main(args,config):
 
 
     net_name = net_kwargs.pop('name')
+    net_kwargs.pop('compile',None)
+    net_kwargs.pop('checkpoint_segments',None)
     try:
         net_kwargs.pop('type')
     except:
@@ -96,7 +98,7 @@ def main(args,config):
         for step , batch in tqdm(enumerate( dataloader ) , total = len(dataloader) ):
             for k in batch:
                 if 'img' in k or 'attribute' in k :
-                    batch[k] = batch[k].cuda(async = True)
+                    batch[k] = batch[k].cuda(non_blocking = True)
                     batch[k].requires_grad = False
 
             results = net( batch['img'] ) 
@@ -8,7 +8,9 @@ from tqdm import tqdm
 from time import time
 #from network import *
 import sys
+import warnings
 from functools import partial
+from contextlib import nullcontext
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
@@ -19,6 +21,8 @@ import models.gluoncv_resnet
 import models.utils
 from sklearn.model_selection import train_test_split
 from loss import *
+from checkpoint import CheckpointManager
+from feature_bank import FeatureBank
 
 def distribution(df):
     count = np.zeros(28)
@@ -45,6 +49,10 @@ def get_class_weight(train_distribution,dampening='log'):
 
 def main(config):
 
+    #one process per gpu ( or cpu ) when launched with torchrun , batch_size is per process
+    rank , world_size , device = init_distributed()
+    distributed = world_size > 1
+
     df = pd.read_csv( config.data['train_csv_file'] , index_col = 0  )
     #df.Target = df.Target.apply( lambda x : np.array( x.split(' ') , np.uint8 )  )
     train_df , val_df =  train_test_split( df , test_size = config.data['test_size'] ,random_state = config.train['random_seed'] , stratify = df['Target'].map(lambda x: x[:3] if '27' not in x else '0' ) )
@@ -52,15 +60,35 @@ def main(config):
     print( "train dsitribution : " , train_distribution )
     print( "val dsitribution : " , distribution( val_df ) ) 
     if config.train['MIL']:
+        collate_fn = mil_collate_fn
         train_dataset = MILProteinDataset( config , train_df ,  is_training = True , data_dir = config.data['train_dir'] , image_format = config.data['image_format'] )
         val_dataset = MILProteinDataset( config , val_df ,  is_training = False , data_dir = config.data['train_dir'] , image_format = config.data['image_format'] )
     else:
-
+        collate_fn = default_collate
         train_dataset = ProteinDataset( config , train_df ,  is_training = True , data_dir = config.data['train_dir'] , image_format = config.data['image_format'])
         val_dataset = ProteinDataset( config , val_df ,  is_training = False , data_dir = config.data['train_dir'] , image_format = config.data['image_format'])
 
-    train_dataloader = torch.utils.data.DataLoader(  train_dataset , batch_size = config.train['batch_size']  , collate_fn = mil_collate_fn ,  shuffle = True , drop_last = True , num_workers = 8 , pin_memory = False) 
-    val_dataloader = torch.utils.data.DataLoader(  val_dataset , batch_size = config.train['val_batch_size']  , shuffle = False , drop_last = False , num_workers = 8 , pin_memory = False) 
+    if config.train['MIL'] and config.train['MIL_max_instances'] is not None:
+        #batches hold a fixed number of instances instead of a fixed number of bags
+        assert config.data['class_sampler_dampening'] is None , 'MIL_max_instances packs the bags , it has no weighted sampling'
+        train_sampler = BagBatchSampler( train_dataset.bag_sizes() , config.train['MIL_max_instances'] , shuffle = True , bucket_size = config.train['MIL_bucket_size'] , drop_last = True , num_replicas = world_size , rank = rank , seed = config.train['random_seed'] if distributed else None )
+        val_sampler = BagBatchSampler( val_dataset.bag_sizes() , config.train['MIL_max_instances'] , shuffle = False , num_replicas = world_size , rank = rank )
+        train_dataloader = torch.utils.data.DataLoader(  train_dataset , batch_sampler = train_sampler , collate_fn = collate_fn , num_workers = 8 , pin_memory = False) 
+        val_dataloader = torch.utils.data.DataLoader(  val_dataset , batch_sampler = val_sampler , collate_fn = collate_fn , num_workers = 8 , pin_memory = False) 
+    else:
+        #images are drawn with the largest class weight of their labels
+        class_weight = get_class_weight( train_distribution , config.data['class_sampler_dampening'] )
+        if class_weight is not None:
+            sample_weight = train_df['Target'].map( lambda x : max( float( class_weight[int(i)] ) for i in x.split() ) ).values
+            train_sampler = DistributedWeightedSampler( sample_weight , len( train_dataset ) , num_replicas = world_size , rank = rank , seed = config.train['random_seed'] )
+        elif distributed:
+            train_sampler = torch.utils.data.distributed.DistributedSampler( train_dataset , shuffle = True , seed = config.train['random_seed'] , drop_last = True )
+        else:
+            train_sampler = torch.utils.data.RandomSampler( train_dataset )
+        #every val image once , DistributedSampler would pad the last ranks with repeated images
+        val_sampler = range( rank , len( val_dataset ) , world_size ) if distributed else None
+        train_dataloader = torch.utils.data.DataLoader(  train_dataset , batch_size = config.train['batch_size']  , collate_fn = collate_fn ,  sampler = train_sampler , drop_last = True , num_workers = 8 , pin_memory = False) 
+        val_dataloader = torch.utils.data.DataLoader(  val_dataset , batch_size = config.train['val_batch_size']  , collate_fn = collate_fn , sampler = val_sampler , shuffle = False , drop_last = False , num_workers = 8 , pin_memory = False) 
     '''
     for k in val_dataset_name:
         val_dataset = ZeroDataset(config.train['val_img_list'][k], config, is_training= False , has_filename = True)
@@ -70,18 +98,32 @@ def main(config):
 
     net_kwargs = deepcopy( config.net )
     net_name = net_kwargs.pop('name')
+    compile_mode = net_kwargs.pop('compile')
+    segments = net_kwargs.pop('checkpoint_segments')
 
     #net = eval(net_name)( **net_kwargs )
     #config.net['name'] = net_name
     #net = gluoncvth.models.get_deeplab_resnet34_ade(pretrained=True)
     net = eval('models.{}'.format(net_name))( **net_kwargs)
+    models.utils.checkpoint_segments( net , segments )
     #net = eval('models.torchvision_resnet.{}'.format( net_name))( pretrained=True , **net_kwargs )
     #net = eval('models.torchvision_resnet.{}'.format(net_name))( pretrained=True , **net_kwargs )
-    net = nn.DataParallel( net )
-    net.cuda()
+    if config.train['sync_bn'] and distributed:
+        if device.type == 'cuda':
+            net = nn.SyncBatchNorm.convert_sync_batchnorm( net )
+        else:
+            warnings.warn( 'SyncBatchNorm needs gpus , the batch norms stay per process' )
+    net.to( device )
+    if distributed:
+        #the frozen feature layers get no gradient during the first epochs
+        net = nn.parallel.DistributedDataParallel( net , device_ids = [ device.index ] if device.type == 'cuda' else None , find_unused_parameters = config.train['freeze_feature_layer_epochs'] > 0 )
+    else:
+        net = nn.DataParallel( net )
     
-    tb = TensorBoardX(config = config , log_dir = config.train['log_dir'] , log_type = ['train' , 'val' , 'net'] )
+    #only the first process logs and saves checkpoints
+    tb = ( TensorBoardX if rank == 0 else NullTensorBoardX )(config = config , log_dir = config.train['log_dir'] , log_type = ['train' , 'val' , 'net'] )
     tb.write_net(str(net),silent=False)
+    monitor = ParamMonitor( net , config.train['monitor_layers'] )
 
     optim_config = models.utils.get_optim_config(net,config.train['lr_for_parts'])
 
@@ -90,10 +132,11 @@ def main(config):
 
     assert config.train['optimizer'] in ['Adam' , 'SGD']
     if config.train['optimizer'] == 'Adam':
-        optimizer_fn = partial( torch.optim.Adam  ,  optim_config , lr = config.train['learning_rate']  , betas = config.train['betas'] ,  weight_decay = 0 , amsgrad = config.train['amsgrad']  )
+        optimizer_fn = partial( torch.optim.Adam  ,  optim_config , lr = config.train['learning_rate']  , betas = config.train['betas'] ,  weight_decay = 0 , amsgrad = config.train['amsgrad'] , foreach = config.train['foreach'] )
     if config.train['optimizer'] == 'SGD':
-        optimizer_fn = partial( torch.optim.SGD , optim_config , lr = config.train['learning_rate'] , weight_decay = 0 , momentum = config.train['momentum'] , nesterov = config.train['nesterov'] )
+        optimizer_fn = partial( torch.optim.SGD , optim_config , lr = config.train['learning_rate'] , weight_decay = 0 , momentum = config.train['momentum'] , nesterov = config.train['nesterov'] , foreach = config.train['foreach'] )
     optimizer = optimizer_fn()
+    autocast , scaler = get_amp( config.train['precision'] )
 
 
     
@@ -101,11 +144,13 @@ def main(config):
 
     last_epoch = -1 
     if config.train['resume'] is not None:
-        load_dict = torch.load( config.train['resume'] )
+        load_dict = torch.load( config.train['resume'] , map_location = device )
         last_epoch = load_dict['epoch']
         net.load_state_dict( load_dict['model'] )
         if config.train['resume_optimizer'] :
             optimizer.load_state_dict( load_dict['optimizer'] )
+            if 'scaler' in load_dict:
+                scaler.load_state_dict( load_dict['scaler'] )
         print('Sucessfully load {} , epoch {}'.format(config.train['resume'],last_epoch))
 
     
@@ -120,28 +165,66 @@ def main(config):
 
     weight = get_class_weight(train_distribution,config.loss['class_weight_dampening'])
     print( 'loss weight : ' , weight )
-    compute_loss = eval( config.loss['name'] )(config = config , weight = weight).cuda()
+    compute_loss = eval( config.loss['name'] )(config = config , weight = weight).to( device )
+
+    #net and compute_loss keep the parameters , forward_fn and loss_fn run them
+    forward_fn , loss_fn = net , compute_loss
+    if compile_mode:
+        forward_fn = CompiledForward( net , compile_mode )
+        if forward_fn.mode == 'compile':
+            loss_fn = compile_loss( compute_loss )
+        report = compare_forward( net , forward_fn , next( iter( val_dataloader ) )['img'].to( device ) )
+        tb.write_log( '{} : max abs diff {:.2e} , eager step {:.4f}s , compiled step {:.4f}s'.format( forward_fn.mode , report['max_abs_diff'] , report['eager_step_time'] , report['compiled_step_time'] ) )
+    if len( segments ) > 0:
+        report = models.utils.checkpoint_report( net , next( iter( val_dataloader ) )['img'].to( device ) )
+        tb.write_log( 'checkpointed {} : step {:.4f}s -> {:.4f}s , peak memory {} -> {} MB'.format( segments , report['eager_step_time'] , report['checkpointed_step_time'] , report['eager_peak_memory'] , report['checkpointed_peak_memory'] ) )
 
    
+    checkpoints = CheckpointManager( '{}/models'.format(tb.path) , log_fn = tb.write_log , run = config.train['sub_dir'] ) if rank == 0 else None
     best_metric = {}
     for k,save_max in config.train['save_metric'].items():
         best_metric[k] = ((-1)**save_max ) *1e9  
     log_parser = LogParser()
 
-    origin_curve = config.train['lr_curve']
-    for epoch in tqdm(range( last_epoch + 1  , config.train['num_epochs'] ) , file = sys.stdout , desc = 'epoch' , leave=False ):
+    #the lr schedule and tensorboard count optimizer steps , not micro-batches
+    accumulate_steps = config.train['accumulate_steps']
+    num_optim_steps = ( len( train_dataloader ) + accumulate_steps - 1 ) // accumulate_steps
+    #lr and momentum of every step , including the freeze epochs
+    lr_schedule = LRSchedule( config , num_optim_steps )
+    if config.train['resume'] is not None and 'lr_schedule' in load_dict:
+        lr_schedule.load_state_dict( load_dict['lr_schedule'] )
+
+    #the freeze epochs train the classifier from the features of the frozen backbone , computed once
+    bank_dataloaders = None
+    if config.train['feature_bank'] and last_epoch + 1 < config.train['freeze_feature_layer_epochs']:
+        #the head is called outside of DistributedDataParallel , its gradients would not be all-reduced
+        assert not distributed , 'the feature bank runs on one process'
+        bank_dataloaders = {}
+        for k , dataloader , num_augmentations in [ ( 'train' , train_dataloader , config.train['feature_bank'] ) , ( 'val' , val_dataloader , 1 ) ]:
+            bank = FeatureBank( '{}/feature_bank/{}'.format( tb.path , k ) )
+            bank.build( net , dataloader.dataset , collate_fn , config.train['val_batch_size'] , device , autocast , num_augmentations = num_augmentations )
+            #same samplers , the bank items have the indices of the dataset
+            if dataloader.batch_size is None:
+                bank_dataloaders[k] = torch.utils.data.DataLoader( bank.dataset( config.train['MIL'] ) , batch_sampler = dataloader.batch_sampler , collate_fn = collate_fn , num_workers = 0 )
+            else:
+                bank_dataloaders[k] = torch.utils.data.DataLoader( bank.dataset( config.train['MIL'] ) , batch_size = dataloader.batch_size , sampler = dataloader.sampler , collate_fn = collate_fn , drop_last = dataloader.drop_last , num_workers = 0 )
+            tb.write_log( 'feature bank {} : {} items , {} augmentations'.format( k , len( bank_dataloaders[k].dataset ) , num_augmentations ) )
+    head_fn = lambda img : { 'fc' : net.module.classifier( img ) }
 
+    for epoch in tqdm(range( last_epoch + 1  , config.train['num_epochs'] ) , file = sys.stdout , desc = 'epoch' , leave=False ):
 
 
-        #adjust learning rate
-        if epoch < config.train['freeze_feature_layer_epochs'] :
-            config.train['lr_curve'] = config.train['freeze_lr_curve']
-        elif epoch == config.train['freeze_feature_layer_epochs']:
-            #lr_find( partial( compute_loss , epoch = 0 ) , net , optimizer , train_dataloader , forward_fn = lambda batch : net( batch['img'] ) , plot_name = '../data/tmp/epoch_{}_begin.png'.format(epoch) )
-            config.train['lr_curve'] = origin_curve 
 
-        if config.train['lr_find'] and epoch in config.loss['stage_epoch']:
-            lr_find( partial( compute_loss , epoch = epoch ) , net , optimizer , train_dataloader , forward_fn = lambda batch : net( batch['img'] ) , plot_name = '{}/lr_find_epoch_{}.png'.format(tb.path,epoch) )
+        #lr_find stops on the loss of each process , they would not stay in step
+        if config.train['lr_find'] and epoch in config.loss['stage_epoch'] and not distributed:
+            suggested_lr = lr_find( partial( compute_loss , epoch = epoch ) , net , optimizer , train_dataloader , forward_fn = lambda batch : net( batch['img'] ) , num_iter = config.train['lr_find_steps'] , plot_name = '{}/lr_find_epoch_{}.png'.format(tb.path,epoch) , autocast = autocast , scaler = scaler )
+            tb.write_log( 'lr_find epoch {} : suggested lr {}'.format( epoch , suggested_lr ) )
+            if config.train['lr_find_apply'] and suggested_lr is not None:
+                tb.write_log( 'lrs : {}'.format( scale_lrs( config , epoch , suggested_lr ) ) )
+                #new curves , same position ( restored by a resume )
+                last_step = lr_schedule.last_step
+                lr_schedule = LRSchedule( config , num_optim_steps )
+                lr_schedule.last_step = last_step
             torch.cuda.empty_cache()
 
             
@@ -155,6 +238,13 @@ def main(config):
         if epoch in config.train['restart_optimizer'] :
             optimizer =  optimizer_fn()
 
+        for sampler in [ train_dataloader.sampler , train_dataloader.batch_sampler ]:
+            if hasattr( sampler , 'set_epoch' ):
+                sampler.set_epoch( epoch )
+
+        use_bank = bank_dataloaders is not None and epoch < config.train['freeze_feature_layer_epochs']
+        epoch_forward_fn = head_fn if use_bank else forward_fn
+
         log_dicts = {}
 
         #train
@@ -162,22 +252,27 @@ def main(config):
             net.train()
             compute_loss.train()
             log_t = time()
-            train_loss_log_list = [] 
-            data_loader = train_dataloader
-            length = len(train_dataloader)
-            for step , batch in tqdm(enumerate( data_loader) , total = length , file = sys.stdout , desc = 'training' , leave=False):
-                #adjust learning rate
-                mannual_learning_rate(optimizer,epoch,step,length,config)
-
-                tb.add_scalar( 'lr' , optimizer.param_groups[-1]['lr'] , epoch*len(train_dataloader) + step , 'train')
-                if 'momentum' in optimizer.param_groups[-1]:
-                    tb.add_scalar( 'momentum' , optimizer.param_groups[-1]['momentum'] , epoch*len(train_dataloader) + step , 'train')
-                if 'betas' in optimizer.param_groups[-1]:
-                    tb.add_scalar( 'beta1' , optimizer.param_groups[-1]['betas'][0] , epoch*len(train_dataloader) + step , 'train')
-
-                if config.train['MIL']:
-                    bag_sizes = [ len( v ) for v in batch['img'] ]
-                    batch['img'] = torch.cat( batch['img'] , 0 )
+            #loss sums and confusion counts stay on the gpu , read back every metric_sync_step optimizer steps
+            metrics = MetricAccumulator( distributed )
+            data_loader = bank_dataloaders['train'] if use_bank else train_dataloader
+            length = len(data_loader)
+            for micro_step , batch in tqdm(enumerate( data_loader) , total = length , file = sys.stdout , desc = 'training' , leave=False):
+                #one optimizer step every accumulate_steps micro-batches , the last group of the epoch may be shorter
+                step = micro_step // accumulate_steps
+                group_start = step * accumulate_steps
+                group_length = min( accumulate_steps , length - group_start )
+                global_step = epoch * num_optim_steps + step
+                if micro_step == group_start:
+                    #adjust learning rate
+                    lr_schedule.apply( optimizer , epoch , step )
+
+                    tb.add_scalar( 'lr' , optimizer.param_groups[-1]['lr'] , global_step , 'train')
+                    if 'momentum' in optimizer.param_groups[-1]:
+                        tb.add_scalar( 'momentum' , optimizer.param_groups[-1]['momentum'] , global_step , 'train')
+                    if 'betas' in optimizer.param_groups[-1]:
+                        tb.add_scalar( 'beta1' , optimizer.param_groups[-1]['betas'][0] , global_step , 'train')
+                    optimizer.zero_grad()
+                last_micro_step = micro_step == group_start + group_length - 1
 
                 if config.train['mix_up']:
                     batch_size = batch['img'].shape[0]
@@ -203,72 +298,58 @@ def main(config):
 
                 for k in batch:
                     if not k in ['filename']:
-                        batch[k] = batch[k].cuda(async =  True) 
+                        batch[k] = batch[k].to( device , non_blocking = True ) 
                         batch[k].detach_() 
 
-                results = net( batch['img'] )
+                #the gradients are only all-reduced on the last micro-batch of a group
+                with autocast() , ( net.no_sync() if distributed and not last_micro_step else nullcontext() ):
+                    results = epoch_forward_fn( batch['img'] )
+                results = float_results( results )
 
                 #aggregate results
                 if config.train['MIL']:
-                    new_results = {}
-                    for k in results:
-                        new_results[k] = []
-                    cnt = 0
-                    for bag_size in  bag_sizes : 
-                        for k in results:
-                            new_results[k].append( config.train['MIL_aggregate_fn']( results[k][cnt:cnt+bag_size ]  )  )
-                            cnt += bag_size
-                    new_results = { k:torch.stack( new_results[k] , 0  ) for k in results }
-                    results = new_results
-
-
-                loss_dict = compute_loss( results , batch  , epoch )
-                optimizer.zero_grad()
-                loss_dict['total'].backward()
-                nn.utils.clip_grad_norm_( net.parameters()  , config.train['clip_grad_norm'])
-                for group in optimizer.param_groups:
-                    for param in group['params']:
-                        param.data.mul_( 1 - group['true_weight_decay'] *  group['lr'])
-                optimizer.step()
-                loss_dict.pop('total')
-
-                for k in loss_dict:
-                    if len(loss_dict[k].shape) == 0 :
-                        loss_dict[k] = float(loss_dict[k].cpu().detach().numpy())
-                        tb.add_scalar( k , loss_dict[k] , epoch*len(train_dataloader) + step , 'train' )
-                    else:
-                        loss_dict[k] = loss_dict[k].cpu().detach().numpy()
-                train_loss_log_list.append( { k:loss_dict[k] for k in loss_dict} )
-
-                if step % config.train['log_step'] == 0 and epoch == last_epoch + 1 :
+                    results = aggregate_results( results , batch['bag_index'] , len( batch['offsets'] ) - 1 , config.train['MIL_aggregate'] )
+
+
+                loss_dict = loss_fn( results , batch  , epoch )
+                #gradients of the group sum up to the gradient of its mean loss
+                scaler.scale( loss_dict['total'] / group_length ).backward()
+                if last_micro_step:
+                    #clip the true gradients
+                    scaler.unscale_( optimizer )
+                    grad_norm = nn.utils.clip_grad_norm_( net.parameters()  , config.train['clip_grad_norm'] , foreach = config.train['foreach'] )
+                    #the scaler skips the step on inf/nan gradients , skip the weight decay with it
+                    if not scaler.is_enabled() or torch.isfinite( grad_norm ):
+                        decoupled_weight_decay( optimizer , config.train['foreach'] )
+                    scaler.step( optimizer )
+                    scaler.update()
+                metrics.update( loss_dict )
+                if not last_micro_step:
+                    continue
+
+                print_step = step % config.train['log_step'] == 0 and epoch == last_epoch + 1
+                if step % config.train['metric_sync_step'] == 0 or print_step:
+                    #mean of the losses since the last sync
+                    scalars = metrics.interval()
+                    for k in scalars:
+                        tb.add_scalar( k , scalars[k] , global_step , 'train' )
+
+                if print_step:
                     log_msg = 'step {} lr {} : '.format(step,optimizer.param_groups[0]['lr'])
-                    for k in filter( lambda x:isinstance(loss_dict[x],float) and x not in ['err'], loss_dict):
-                        log_msg += "{} : {} ".format(k,loss_dict[k] )
+                    for k in filter( lambda x: x not in ['err'], scalars):
+                        log_msg += "{} : {} ".format(k,scalars[k] )
                     tqdm.write( log_msg  , file=sys.stdout )
-                            
-                    for k,v in net.named_parameters():
-                        if v.requires_grad and v.grad is not None:
-                            try:
-                                tb.add_histogram( k , v , (epoch)*len(train_dataloader) + step , 'net' )
-                            except Exception as e:
-                                print( "{} is not finite".format(k)   )
-                                raise e
-                            try:
-                                tb.add_histogram( k+'_grad' , v.grad , (epoch)*len(train_dataloader) + step , 'net' )
-                            except Exception as e:
-                                print( "{}.grad is not finite".format(k)   )
-                                raise e
-
-
-            log_dict = {}
-            for k in train_loss_log_list[0]:
-                if isinstance(train_loss_log_list[0][k] , float ):
-                    log_dict[k] = float( np.mean( [dic[k] for dic in train_loss_log_list ]  ) )
-                else:
-                    log_dict[k] = np.concatenate(  [dic[k] for dic in train_loss_log_list ] , axis = 0  )
-                    #log_dict[k] = [dic[k] for dic in train_loss_log_list ]
-            #log_dict = { k: float( np.mean( [ dic[k] for dic in train_loss_log_list ] )) for k in train_loss_log_list[0] }
-            return log_dict
+
+                if config.train['monitor_step'] and global_step % config.train['monitor_step'] == 0:
+                    non_finite = monitor.non_finite()
+                    #with loss scaling an overflowed step is skipped and its gradients are expected to be non finite
+                    if any( not k.endswith( '_grad' ) or not scaler.is_enabled() for k in non_finite ):
+                        raise RuntimeError( '{} are not finite'.format( non_finite ) )
+                    if len( non_finite ) == 0:
+                        monitor.log( tb , global_step )
+
+
+            return metrics.result()
 
         log_dicts['train'] = train() 
 
@@ -277,57 +358,30 @@ def main(config):
         compute_loss.eval()
         def validate( val_dataloader):
 
-            val_loss_log_list= [ ]
+            metrics = MetricAccumulator( distributed )
             with torch.no_grad():
                 first_val = False
                 for step , batch in tqdm( enumerate( val_dataloader ) , total = len( val_dataloader ) , desc = 'validating' , leave = False  ):
 
 
-                    if config.train['MIL']:
-                        bag_sizes = [ len( v ) for v in batch['img'] ]
-                        batch['img'] = torch.cat( batch['img'] , 0 )
-
                     for k in batch:
                         if not k in ['filename']:
-                            batch[k] = batch[k].cuda(async =  True) 
+                            batch[k] = batch[k].to( device , non_blocking = True ) 
                             batch[k].requires_grad = False
 
-                    results = net( batch['img'] )
+                    with autocast():
+                        results = epoch_forward_fn( batch['img'] )
+                    results = float_results( results )
 
                     #aggregate results
                     if config.train['MIL']:
-                        new_results = {}
-                        for k in results:
-                            new_results[k] = []
-                        cnt = 0
-                        for bag_size in  bag_sizes : 
-                            for k in results:
-                                new_results[k].append( config.train['MIL_aggregate_fn']( results[k][cnt:cnt+bag_size ]  )  )
-                                cnt += bag_size
-                        new_results = { k:torch.stack( new_results[k] , 0  ) for k in results }
-                        results = new_results
-
-                    loss_dict = compute_loss( results , batch , epoch )
-                    loss_dict.pop('total')
-
-
-                    for k in loss_dict:
-                        if len(loss_dict[k].shape) == 0 :
-                            loss_dict[k] = float(loss_dict[k].cpu().detach().numpy())
-                        else:
-                            loss_dict[k] = loss_dict[k].cpu().detach().numpy()
-                    val_loss_log_list.append( { k:loss_dict[k] for k in loss_dict} )
-                #log_dict = { k: float( np.mean( [ dic[k] for dic in val_loss_log_list ] )) for k in val_loss_log_list[0] }
-                log_dict = {}
-                for k in val_loss_log_list[0]:
-                    if isinstance(val_loss_log_list[0][k] , float ) :
-                        log_dict[k] = float( np.mean( [dic[k] for dic in val_loss_log_list ]  ) )
-                    else:
-                        #log_dict[k] = [dic[k] for dic in val_loss_log_list ] 
-                        log_dict[k] = np.concatenate(  [dic[k] for dic in val_loss_log_list ] , axis = 0  )
-                return log_dict
+                        results = aggregate_results( results , batch['bag_index'] , len( batch['offsets'] ) - 1 , config.train['MIL_aggregate'] )
 
-        log_dicts['val'] =  validate(  val_dataloader  ) 
+                    loss_dict = loss_fn( results , batch , epoch )
+                    metrics.update( loss_dict )
+                return metrics.result()
+
+        log_dicts['val'] =  validate(  bank_dataloaders['val'] if use_bank else val_dataloader  ) 
 
         #print to stdout
         num_imgs = config.train['batch_size'] * len(train_dataloader) + config.train['val_batch_size'] * len(val_dataloader) 
@@ -335,52 +389,44 @@ def main(config):
         tb.write_log(  log_msg  , use_tqdm = True )
 
         #log to tensorboard
-        log_net_params(tb,net,epoch,len(train_dataloader))
+        log_net_params(tb,net,epoch,num_optim_steps,monitor)
 
         for tag in log_dicts:
             if 'val' in tag:
                 for k,v in log_dicts[tag].items():
                     if isinstance( v  , float ) :
-                        tb.add_scalar( k , v , (epoch+1)*len(train_dataloader) , tag ) 
+                        tb.add_scalar( k , v , (epoch+1)*num_optim_steps , tag ) 
                     else:
-                        tb.add_histogram( k , v , (epoch+1)*len(train_dataloader) , tag )
-
-        #save
+                        tb.add_histogram( k , v , (epoch+1)*num_optim_steps , tag )
 
+        #save , the same checkpoint under every name it gets this epoch
+        names = ['last.pth']
         for k , save_max in config.train['save_metric'].items():
             cmp_fn = max if save_max else min
             new_metric = log_dicts['val'][k]
             if cmp_fn( best_metric[k] , new_metric ) == new_metric :
                 best_metric[k] = new_metric
-                torch.save( { 
-                    k:best_metric[k],
-                    'epoch':epoch,
-                    'model':net.state_dict(),
-                    'optimizer':optimizer.state_dict()
-                } , '{}/models/{}'.format(tb.path,'best_{}.pth'.format(k)))
-
-        #save last snapshot
-        torch.save( {
-            **best_metric,
-            'epoch':epoch,
-            'model':net.state_dict(),
-            'optimizer':optimizer.state_dict()
-        }, '{}/models/{}'.format(tb.path,'last.pth') )
-        
+                names.append( 'best_{}.pth'.format(k) )
         if epoch % 10 == 10 -1 :
-            torch.save( {
+            names.append( '_{}.pth'.format(epoch) )
+        if checkpoints is not None:
+            checkpoints.save( {
                 **best_metric,
                 'epoch':epoch,
                 'model':net.state_dict(),
-                'optimizer':optimizer.state_dict()
-            }, '{}/models/{}'.format(tb.path,'_{}.pth'.format(epoch)) )
-
-
-
-
+                'optimizer':optimizer.state_dict(),
+                'scaler':scaler.state_dict(),
+                'lr_schedule':lr_schedule.state_dict()
+            } , names , metrics = { k:v for k,v in log_dicts['val'].items() if isinstance( v , float ) } )
 
     #tb.write_log("best : {}".format( k ,best_metric[k]) )
     tb.write_log("best : {}".format( best_metric ) )
+    if checkpoints is not None:
+        checkpoints.close()
+    tb.close()
+    if distributed:
+        torch.distributed.barrier()
+        torch.distributed.destroy_process_group()
     return { 'log_path':tb.path , **best_metric }
 
 
@@ -9,13 +9,19 @@ train = {}
 train['random_seed'] = 0
 
 train['MIL'] = False
-train['MIL_aggregate_fn'] = partial( torch.mean  , dim = 0 )
+train['MIL_aggregate'] = 'mean' #one of 'mean' , 'max' , 'logsumexp' , 'softmax'
+train['MIL_max_instances'] = None #if set , MIL batches are packed up to this many instances instead of batch_size bags
+train['MIL_bucket_size'] = 100 #bags are sorted by size inside buckets of this many random bags before packing
 train['mix_up'] = False
 
 train['batch_size'] = 32 
+train['accumulate_steps'] = 1 #optimizer step every accumulate_steps batches , the effective batch size is batch_size * accumulate_steps
 train['val_batch_size'] = 32
 
 train['log_step'] = 100
+train['metric_sync_step'] = 20 #training losses are read back from the gpu and written to tensorboard every metric_sync_step steps
+train['monitor_step'] = 100 #histograms of monitor_layers weights and gradients and a finiteness check every monitor_step optimizer steps , 0 to disable
+train['monitor_layers'] = 8 #None for every layer
 train['save_epoch'] = 1
 train['save_metric'] = {'macro_f1_score':True , 'bce':False , 'acc':True }#True : saves the max , False : saves the min
 train['optimizer'] = 'Adam'
@@ -30,6 +36,9 @@ train['momentum'] = 0.9
 train['nesterov'] = True 
 
 train['clip_grad_norm'] = 1.0
+train['foreach'] = True #multi-tensor kernels for the optimizer step , the gradient clipping and the weight decay
+train['sync_bn'] = False #SyncBatchNorm when launched on several gpu processes with torchrun
+train['precision'] = 'fp32' #'fp32' , 'fp16' ( with loss scaling , bf16 on cpu ) or 'bf16' , autocast of the forward pass
 train['mannual_learning_rate'] = True
 #settings for mannual tuning
 #train['lr_bounds'] = [ 0 , 40 , 60 , 80 , 100 ]
@@ -38,6 +47,8 @@ train['lr_for_parts'] = [1,1,1]
 #train['lrs'] = [ 1e-1 , 1e-2 , 1e-3 , 1e-4 ]
     
 train['lr_find'] = True
+train['lr_find_steps'] = 100 #steps of the lr range test , at most one epoch
+train['lr_find_apply'] = False #scale train['lrs'] so that the lr from that epoch on is the suggested one , instead of tuning ilr by hand
 
 #settings for cosine annealing learning rate
 train['lr_curve'] = 'one_cycle'
@@ -48,6 +59,7 @@ assert train['lr_curve'] in ['cosine','cyclical','one_cycle','normal']
 #train['lrs'] = [1e-1,1e-2,1e-3,1e-4]
 train['freeze_feature_layer_epochs'] = 2
 train['freeze_lr_curve'] = 'one_cycle'
+train['feature_bank'] = 0 #if > 0 , the freeze epochs train the classifier on pooled features of the frozen backbone , computed once over this many augmentation passes , see feature_bank.py
 assert train['freeze_lr_curve'] in ['cosine','cyclical','one_cycle','normal'] 
 ilr = 2e-2
 train['lrs'] = [ ilr , ilr , ilr/4 , ilr/4 ,  ilr/4 , ilr/4 ,ilr/4 ,ilr/4 , ilr/16 ]
@@ -75,6 +87,8 @@ net = {}
 net['name'] = 'gluoncv_resnet_v15.resnet34'
 net['input_shape'] = (512,512)
 net['pretrained'] = False
+net['compile'] = False #True , 'compile' or 'trace' : channels_last and torch.compile ( 'trace' : torch.jit.trace , True : compile when available ) , see utils.CompiledForward
+net['checkpoint_segments'] = [] #sub-modules recomputed in the backward instead of keeping their activations , e.g. ['layer1','layer2'] , 'layer3.0' or the v11 decoder blocks 'd4' , see models.utils.checkpoint_segments
 
 
 
@@ -99,6 +113,7 @@ loss['class_weight_dampening'] = 'log'
 
 test = {}
 test['model'] = '../save/gluoncv_resnet_v15.resnet34_shape512,512_seed1_Adam/20190104_091713/models/last.pth'
+test['select'] = 'last' #when test['model'] is a models directory : 'last' or a metric of train['save_metric'] , looked up in its catalog
 test['batch_size'] = 8
 test['tta'] = 20
 
@@ -108,7 +123,16 @@ data['test_size'] = 0.2
 data['train_dir'] = ''
 data['test_dir'] = '../data/test'
 data['smooth_label_epsilon'] = 0.0
+data['class_sampler_dampening'] = None #None samples the train images uniformly , 'log' with the largest get_class_weight of their labels
 data['image_format'] = 'png'
+#how MIL crops are stored : 'files' ( one image per crop and channel ) , 'packed' ( one .npz per image , see preprocess --pack )
+#or 'centers' ( cropped on the fly from the full images around the nucleus centers in mil_centers_file , see preprocess --centers_only )
+data['mil_crop_mode'] = 'files'
+data['mil_centers_file'] = '../data/single_cell_crop_centers.csv'
+data['mil_crop_scale'] = 4 #downscale factor used by the segmentation step ( its --scale , checked against mil_centers_file.json )
+data['mil_crop_size'] = 128
+data['mil_center_jitter'] = 0 #max random shift ( in pixels ) of the crop centers during training
+data['mil_max_bag_size'] = None #if set , bags with more instances are randomly subsampled during training
 
 
 def parse_config():
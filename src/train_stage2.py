@@ -19,6 +19,7 @@ import models.gluoncv_resnet
 import models.utils
 from sklearn.model_selection import train_test_split
 from loss import *
+from checkpoint import CheckpointManager
 
 def distribution(df):
     count = np.zeros(28)
@@ -58,10 +59,11 @@ def main(config):
     print( "train dsitribution : " , train_distribution )
     print( "val dsitribution : " , distribution( val_df ) ) 
     if config.train['MIL']:
+        collate_fn = mil_collate_fn
         train_dataset = MILProteinDataset( config , train_df ,  is_training = True , data_dir = config.data['train_dir'] , image_format = config.data['image_format'] )
         val_dataset = MILProteinDataset( config , val_df ,  is_training = False , data_dir = config.data['train_dir'] , image_format = config.data['image_format'] )
     else:
-
+        collate_fn = default_collate
         train_dataset = ProteinDataset( config , train_df ,  is_training = True , data_dir = config.data['train_dir'] , image_format = config.data['image_format'])
         val_dataset = ProteinDataset( config , val_df ,  is_training = False , data_dir = config.data['train_dir'] , image_format = config.data['image_format'])
 
@@ -71,8 +73,8 @@ def main(config):
         sampler = torch.utils.data.RandomSampler( train_dataset )
     else:
         sampler = torch.utils.data.WeightedRandomSampler( weights = sampler_weight , num_samples = len( train_dataset ) , replacement = True )
-    train_dataloader = torch.utils.data.DataLoader(  train_dataset , batch_size = config.train['batch_size']  , collate_fn = mil_collate_fn ,  sampler = sampler , drop_last = True , num_workers = 8 , pin_memory = False) 
-    val_dataloader = torch.utils.data.DataLoader(  val_dataset , batch_size = config.train['val_batch_size']  , shuffle = False , drop_last = False , num_workers = 8 , pin_memory = False) 
+    train_dataloader = torch.utils.data.DataLoader(  train_dataset , batch_size = config.train['batch_size']  , collate_fn = collate_fn ,  sampler = sampler , drop_last = True , num_workers = 8 , pin_memory = False) 
+    val_dataloader = torch.utils.data.DataLoader(  val_dataset , batch_size = config.train['val_batch_size']  , collate_fn = collate_fn , shuffle = False , drop_last = False , num_workers = 8 , pin_memory = False) 
     '''
     for k in val_dataset_name:
         val_dataset = ZeroDataset(config.train['val_img_list'][k], config, is_training= False , has_filename = True)
@@ -82,11 +84,14 @@ def main(config):
 
     net_kwargs = deepcopy( config.net )
     net_name = net_kwargs.pop('name')
+    compile_mode = net_kwargs.pop('compile',False)
+    segments = net_kwargs.pop('checkpoint_segments',[])
 
     #net = eval(net_name)( **net_kwargs )
     #config.net['name'] = net_name
     #net = gluoncvth.models.get_deeplab_resnet34_ade(pretrained=True)
     net = eval('models.{}'.format(net_name))( **net_kwargs)
+    models.utils.checkpoint_segments( net , segments )
     #net = eval('models.torchvision_resnet.{}'.format( net_name))( pretrained=True , **net_kwargs )
     #net = eval('models.torchvision_resnet.{}'.format(net_name))( pretrained=True , **net_kwargs )
     net = nn.DataParallel( net )
@@ -94,6 +99,7 @@ def main(config):
     
     tb = TensorBoardX(config = config , log_dir = config.train['log_dir'] , log_type = ['train' , 'val' , 'net'] )
     tb.write_net(str(net),silent=True)
+    monitor = ParamMonitor( net , config.train['monitor_layers'] )
 
     optim_config = models.utils.get_optim_config(net,config.train['lr_for_parts'])
 
@@ -102,10 +108,11 @@ def main(config):
 
     assert config.train['optimizer'] in ['Adam' , 'SGD']
     if config.train['optimizer'] == 'Adam':
-        optimizer_fn = partial( torch.optim.Adam  ,  optim_config , lr = config.train['learning_rate']  , betas = config.train['betas'] ,  weight_decay = 0 , amsgrad = config.train['amsgrad']  )
+        optimizer_fn = partial( torch.optim.Adam  ,  optim_config , lr = config.train['learning_rate']  , betas = config.train['betas'] ,  weight_decay = 0 , amsgrad = config.train['amsgrad'] , foreach = config.train['foreach'] )
     if config.train['optimizer'] == 'SGD':
-        optimizer_fn = partial( torch.optim.SGD , optim_config , lr = config.train['learning_rate'] , weight_decay = 0 , momentum = config.train['momentum'] , nesterov = config.train['nesterov'] )
+        optimizer_fn = partial( torch.optim.SGD , optim_config , lr = config.train['learning_rate'] , weight_decay = 0 , momentum = config.train['momentum'] , nesterov = config.train['nesterov'] , foreach = config.train['foreach'] )
     optimizer = optimizer_fn()
+    autocast , scaler = get_amp( config.train['precision'] )
 
 
     
@@ -118,6 +125,8 @@ def main(config):
         net.load_state_dict( load_dict['model'] )
         if config.train['resume_optimizer'] :
             optimizer.load_state_dict( load_dict['optimizer'] )
+            if 'scaler' in load_dict:
+                scaler.load_state_dict( load_dict['scaler'] )
         print('Sucessfully load {} , epoch {}'.format(config.train['resume'],last_epoch))
 
     
@@ -134,26 +143,36 @@ def main(config):
     print( 'loss weight : ' , weight )
     compute_loss = eval( config.loss['name'] )(config = config , weight = weight).cuda()
 
+    #net and compute_loss keep the parameters , forward_fn and loss_fn run them
+    forward_fn , loss_fn = net , compute_loss
+    if compile_mode:
+        forward_fn = CompiledForward( net , compile_mode )
+        if forward_fn.mode == 'compile':
+            loss_fn = compile_loss( compute_loss )
+        report = compare_forward( net , forward_fn , next( iter( val_dataloader ) )['img'].cuda() )
+        tb.write_log( '{} : max abs diff {:.2e} , eager step {:.4f}s , compiled step {:.4f}s'.format( forward_fn.mode , report['max_abs_diff'] , report['eager_step_time'] , report['compiled_step_time'] ) )
+    if len( segments ) > 0:
+        report = models.utils.checkpoint_report( net , next( iter( val_dataloader ) )['img'].cuda() )
+        tb.write_log( 'checkpointed {} : step {:.4f}s -> {:.4f}s , peak memory {} -> {} MB'.format( segments , report['eager_step_time'] , report['checkpointed_step_time'] , report['eager_peak_memory'] , report['checkpointed_peak_memory'] ) )
+
    
+    checkpoints = CheckpointManager( '{}/models'.format(tb.path) , log_fn = tb.write_log , run = config.train['sub_dir'] )
     best_metric = {}
     for k,save_max in config.train['save_metric'].items():
         best_metric[k] = ((-1)**save_max ) *1e9  
     log_parser = LogParser()
 
-    origin_curve = config.train['lr_curve']
-    for epoch in tqdm(range( last_epoch + 1  , config.train['num_epochs'] ) , file = sys.stdout , desc = 'epoch' , leave=False ):
+    #lr and momentum of every step , including the freeze epochs
+    lr_schedule = LRSchedule( config , len( train_dataloader ) )
+    if config.train['resume'] is not None and 'lr_schedule' in load_dict:
+        lr_schedule.load_state_dict( load_dict['lr_schedule'] )
 
+    for epoch in tqdm(range( last_epoch + 1  , config.train['num_epochs'] ) , file = sys.stdout , desc = 'epoch' , leave=False ):
 
 
-        #adjust learning rate
-        if epoch < config.train['freeze_feature_layer_epochs'] :
-            config.train['lr_curve'] = config.train['freeze_lr_curve']
-        elif epoch == config.train['freeze_feature_layer_epochs']:
-            #lr_find( partial( compute_loss , epoch = 0 ) , net , optimizer , train_dataloader , forward_fn = lambda batch : net( batch['img'] ) , plot_name = '../data/tmp/epoch_{}_begin.png'.format(epoch) )
-            config.train['lr_curve'] = origin_curve 
 
         if config.train['lr_find'] and epoch in config.loss['stage_epoch']:
-            lr_find( partial( compute_loss , epoch = epoch ) , net , optimizer , train_dataloader , forward_fn = lambda batch : net( batch['img'] ) , plot_name = '{}/lr_find_epoch_{}.png'.format(tb.path,epoch) )
+            lr_find( partial( compute_loss , epoch = epoch ) , net , optimizer , train_dataloader , forward_fn = lambda batch : net( batch['img'] ) , num_iter = config.train['lr_find_steps'] , plot_name = '{}/lr_find_epoch_{}.png'.format(tb.path,epoch) )
             torch.cuda.empty_cache()
 
             
@@ -179,7 +198,7 @@ def main(config):
             length = len(train_dataloader)
             for step , batch in tqdm(enumerate( data_loader) , total = length , file = sys.stdout , desc = 'training' , leave=False):
                 #adjust learning rate
-                mannual_learning_rate(optimizer,epoch,step,length,config)
+                lr_schedule.apply( optimizer , epoch , step )
 
                 tb.add_scalar( 'lr' , optimizer.param_groups[-1]['lr'] , epoch*len(train_dataloader) + step , 'train')
                 if 'momentum' in optimizer.param_groups[-1]:
@@ -187,39 +206,31 @@ def main(config):
                 if 'betas' in optimizer.param_groups[-1]:
                     tb.add_scalar( 'beta1' , optimizer.param_groups[-1]['betas'][0] , epoch*len(train_dataloader) + step , 'train')
 
-                if config.train['MIL']:
-                    bag_sizes = [ len( v ) for v in batch['img'] ]
-                    batch['img'] = torch.cat( batch['img'] , 0 )
-
                 for k in batch:
                     if not k in ['filename']:
-                        batch[k] = batch[k].cuda(async =  True) 
+                        batch[k] = batch[k].cuda(non_blocking = True) 
                         batch[k].requires_grad = False
 
-                results = net( batch['img'] )
+                with autocast():
+                    results = forward_fn( batch['img'] )
+                results = float_results( results )
 
                 #aggregate results
                 if config.train['MIL']:
-                    new_results = {}
-                    for k in results:
-                        new_results[k] = []
-                    cnt = 0
-                    for bag_size in  bag_sizes : 
-                        for k in results:
-                            new_results[k].append( config.train['MIL_aggregate_fn']( results[k][cnt:cnt+bag_size ]  )  )
-                            cnt += bag_size
-                    new_results = { k:torch.stack( new_results[k] , 0  ) for k in results }
-                    results = new_results
-
-
-                loss_dict = compute_loss( results , batch  , epoch )
+                    results = aggregate_results( results , batch['bag_index'] , len( batch['offsets'] ) - 1 , config.train['MIL_aggregate'] )
+
+
+                loss_dict = loss_fn( results , batch  , epoch )
                 optimizer.zero_grad()
-                loss_dict['total'].backward()
-                nn.utils.clip_grad_norm_( net.parameters()  , config.train['clip_grad_norm'])
-                for group in optimizer.param_groups:
-                    for param in group['params']:
-                        param.data.mul_( 1 - group['true_weight_decay'] *  group['lr'])
-                optimizer.step()
+                scaler.scale( loss_dict['total'] ).backward()
+                #clip the true gradients
+                scaler.unscale_( optimizer )
+                grad_norm = nn.utils.clip_grad_norm_( net.parameters()  , config.train['clip_grad_norm'] , foreach = config.train['foreach'] )
+                #the scaler skips the step on inf/nan gradients , skip the weight decay with it
+                if not scaler.is_enabled() or torch.isfinite( grad_norm ):
+                    decoupled_weight_decay( optimizer , config.train['foreach'] )
+                scaler.step( optimizer )
+                scaler.update()
                 loss_dict.pop('total')
 
                 for k in loss_dict:
@@ -273,31 +284,20 @@ def main(config):
                 for step , batch in tqdm( enumerate( val_dataloader ) , total = len( val_dataloader ) , desc = 'validating' , leave = False  ):
 
 
-                    if config.train['MIL']:
-                        bag_sizes = [ len( v ) for v in batch['img'] ]
-                        batch['img'] = torch.cat( batch['img'] , 0 )
-
                     for k in batch:
                         if not k in ['filename']:
-                            batch[k] = batch[k].cuda(async =  True) 
+                            batch[k] = batch[k].cuda(non_blocking = True) 
                             batch[k].requires_grad = False
 
-                    results = net( batch['img'] )
+                    with autocast():
+                        results = forward_fn( batch['img'] )
+                    results = float_results( results )
 
                     #aggregate results
                     if config.train['MIL']:
-                        new_results = {}
-                        for k in results:
-                            new_results[k] = []
-                        cnt = 0
-                        for bag_size in  bag_sizes : 
-                            for k in results:
-                                new_results[k].append( config.train['MIL_aggregate_fn']( results[k][cnt:cnt+bag_size ]  )  )
-                                cnt += bag_size
-                        new_results = { k:torch.stack( new_results[k] , 0  ) for k in results }
-                        results = new_results
-
-                    loss_dict = compute_loss( results , batch , epoch )
+                        results = aggregate_results( results , batch['bag_index'] , len( batch['offsets'] ) - 1 , config.train['MIL_aggregate'] )
+
+                    loss_dict = loss_fn( results , batch , epoch )
                     loss_dict.pop('total')
 
 
@@ -325,7 +325,7 @@ def main(config):
         tb.write_log(  log_msg  , use_tqdm = True )
 
         #log to tensorboard
-        log_net_params(tb,net,epoch,len(train_dataloader))
+        log_net_params(tb,net,epoch,len(train_dataloader),monitor)
 
         for tag in log_dicts:
             if 'val' in tag:
@@ -335,42 +335,29 @@ def main(config):
                     else:
                         tb.add_histogram( k , v , (epoch+1)*len(train_dataloader) , tag )
 
-        #save
-
+        #save , the same checkpoint under every name it gets this epoch
+        names = ['last.pth']
         for k , save_max in config.train['save_metric'].items():
             cmp_fn = max if save_max else min
             new_metric = log_dicts['val'][k]
             if cmp_fn( best_metric[k] , new_metric ) == new_metric :
                 best_metric[k] = new_metric
-                torch.save( { 
-                    k:best_metric[k],
-                    'epoch':epoch,
-                    'model':net.state_dict(),
-                    'optimizer':optimizer.state_dict()
-                } , '{}/models/{}'.format(tb.path,'best_{}.pth'.format(k)))
-
-        #save last snapshot
-        torch.save( {
+                names.append( 'best_{}.pth'.format(k) )
+        if epoch % 10 == 10 -1 :
+            names.append( '_{}.pth'.format(epoch) )
+        checkpoints.save( {
             **best_metric,
             'epoch':epoch,
             'model':net.state_dict(),
-            'optimizer':optimizer.state_dict()
-        }, '{}/models/{}'.format(tb.path,'last.pth') )
-        
-        if epoch % 10 == 10 -1 :
-            torch.save( {
-                **best_metric,
-                'epoch':epoch,
-                'model':net.state_dict(),
-                'optimizer':optimizer.state_dict()
-            }, '{}/models/{}'.format(tb.path,'_{}.pth'.format(epoch)) )
-
-
-
-
+            'optimizer':optimizer.state_dict(),
+            'scaler':scaler.state_dict(),
+            'lr_schedule':lr_schedule.state_dict()
+        } , names , metrics = { k:v for k,v in log_dicts['val'].items() if isinstance( v , float ) } )
 
     #tb.write_log("best : {}".format( k ,best_metric[k]) )
     tb.write_log("best : {}".format( best_metric ) )
+    checkpoints.close()
+    tb.close()
     return { 'log_path':tb.path , **best_metric }
 
 
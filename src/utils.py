@@ -16,19 +16,191 @@ import math
 from tqdm import tqdm
 
 from copy import deepcopy
+from functools import partial
+from contextlib import nullcontext
+import re
+from checkpoint import Catalog , to_cpu
 import sys
+import inspect
 
-def aggregate_results( results , bag_sizes , aggregate_fn):
-    new_results = {}
-    for k in results:
-        new_results[k] = []
-    cnt = 0
-    for bag_size in  bag_sizes : 
-        for k in results:
-            new_results[k].append( aggregate_fn( results[k][cnt:cnt+bag_size ]  )  )
-            cnt += bag_size
-    new_results = { k:torch.stack( new_results[k] , 0  ) for k in results }
-    return new_results
+def segment_sum( x , bag_index , num_bags ):
+    """
+    sum the instances x ( first dim ) belonging to the same bag , bag_index[i] is the bag of x[i]
+    """
+    return x.new_zeros( ( num_bags , ) + tuple( x.shape[1:] ) ).index_add( 0 , bag_index , x )
+
+def segment_max( x , bag_index , num_bags ):
+    index = bag_index.view( [-1] + [1] * ( x.dim() - 1 ) ).expand_as( x )
+    return x.new_zeros( ( num_bags , ) + tuple( x.shape[1:] ) ).scatter_reduce( 0 , index , x , reduce = 'amax' , include_self = False )
+
+def segment_mean( x , bag_index , num_bags ):
+    bag_sizes = torch.bincount( bag_index , minlength = num_bags ).to( x.dtype )
+    return segment_sum( x , bag_index , num_bags ) / bag_sizes.view( [-1] + [1] * ( x.dim() - 1 ) )
+
+def segment_logsumexp( x , bag_index , num_bags ):
+    m = segment_max( x.detach() , bag_index , num_bags )
+    return m + segment_sum( ( x - m[bag_index] ).exp() , bag_index , num_bags ).log()
+
+def segment_softmax_pool( x , bag_index , num_bags , scores = None , temperature = 1.0 ):
+    """
+    weighted mean of the instances with weights softmax( scores / temperature ) inside each bag ,
+    scores default to x itself
+    """
+    if scores is None:
+        scores = x
+    scores = scores / temperature
+    m = segment_max( scores.detach() , bag_index , num_bags )
+    e = ( scores - m[bag_index] ).exp()
+    w = e / segment_sum( e , bag_index , num_bags )[bag_index]
+    return segment_sum( w * x , bag_index , num_bags )
+
+segment_aggregate_fns = {
+    'mean' : segment_mean,
+    'max' : segment_max,
+    'logsumexp' : segment_logsumexp,
+    'softmax' : segment_softmax_pool,
+}
+
+def aggregate_results( results , bag_index , num_bags , mode = 'mean' ):
+    """
+    aggregate the instance outputs of a MIL batch into bag outputs , one call per batch
+    """
+    aggregate_fn = segment_aggregate_fns[mode]
+    return { k : aggregate_fn( v , bag_index , num_bags ) for k,v in results.items() }
+
+def get_amp( precision ):
+    """
+    autocast context factory and GradScaler for config.train['precision'] ( 'fp32' , 'fp16' or 'bf16' ).
+    fp16 falls back to bf16 on cpu , only fp16 on gpu needs loss scaling , the scaler is a no-op otherwise
+    """
+    assert precision in ['fp32','fp16','bf16']
+    device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dtype = torch.float16 if precision == 'fp16' and device_type == 'cuda' else torch.bfloat16
+    autocast = partial( torch.autocast , device_type , dtype = dtype , enabled = precision != 'fp32' )
+    scaler = torch.amp.GradScaler( device_type , enabled = precision == 'fp16' and device_type == 'cuda' )
+    return autocast , scaler
+
+def init_distributed():
+    """
+    joins the process group when launched by torchrun ( WORLD_SIZE > 1 in the environment ) , nccl on gpus and gloo
+    on cpu. returns rank , world_size and the device of this process
+    """
+    world_size = int( os.environ.get( 'WORLD_SIZE' , 1 ) )
+    rank = int( os.environ.get( 'RANK' , 0 ) )
+    local_rank = int( os.environ.get( 'LOCAL_RANK' , 0 ) )
+    if torch.cuda.is_available():
+        torch.cuda.set_device( local_rank )
+        device = torch.device( 'cuda' , local_rank )
+    else:
+        device = torch.device( 'cpu' )
+    if world_size > 1 and not torch.distributed.is_initialized():
+        torch.distributed.init_process_group( 'nccl' if device.type == 'cuda' else 'gloo' )
+    return rank , world_size , device
+
+class CompiledForward():
+    """
+    forward of a model in channels_last , compiled with torch.compile ( mode 'compile' ) or traced with torch.jit.trace
+    ( mode 'trace' , for torch without torch.compile ). True picks compile when available. the parameters stay those of
+    net , state_dict , the optimizer and DataParallel/DistributedDataParallel are unchanged.
+    traces are made per train/eval mode since they freeze dropout and batch norm behaviour , and of the wrapped module
+    only ( a single device ) , as is the compiled DataParallel model. 4d outputs ( the decoder maps of v11 , the attention weighted maps of v7 ) are returned
+    in the default memory format so the losses can view them
+    """
+    def __init__( self , net , mode = True ):
+        if mode is True:
+            mode = 'compile' if hasattr( torch , 'compile' ) else 'trace'
+        assert mode in ['compile','trace']
+        module = net.module if hasattr( net , 'module' ) else net
+        #the bag models ( v12 ) take the bag sizes too , their graph depends on them
+        num_inputs = len( [ p for p in inspect.signature( module.forward ).parameters.values() if p.default is p.empty ] )
+        if num_inputs != 1:
+            raise ValueError( '{} takes {} inputs , only single input models can be compiled'.format( type( module ).__name__ , num_inputs ) )
+        net.to( memory_format = torch.channels_last )
+        self.mode = mode
+        self.module = module
+        distributed = isinstance( net , torch.nn.parallel.DistributedDataParallel )
+        if torch.cuda.device_count() > 1 and not distributed:
+            warnings.warn( 'the compiled model runs on a single gpu , use torchrun for several' )
+        if mode == 'compile':
+            #DistributedDataParallel is compiled with its gradient buckets , DataParallel is left out
+            self.fn = torch.compile( net if distributed else module )
+        else:
+            self.traced = {}
+
+    def __call__( self , x ):
+        x = x.contiguous( memory_format = torch.channels_last )
+        if self.mode == 'compile':
+            results = self.fn( x )
+        else:
+            if self.module.training not in self.traced:
+                self.traced[self.module.training] = torch.jit.trace( self.module , x , strict = False , check_trace = False )
+            results = self.traced[self.module.training]( x )
+        return { k : v.contiguous() if v.dim() == 4 else v for k,v in results.items() }
+
+def compile_loss( compute_loss ):
+    """
+    torch.compile of a loss called as compute_loss( results , batch , epoch ) , the non tensor entries of the batch
+    ( filenames ) are left out so they do not trigger a recompilation at every batch
+    """
+    fn = torch.compile( compute_loss )
+    def compiled_loss( results , batch , epoch ):
+        return fn( results , { k:v for k,v in batch.items() if isinstance( v , torch.Tensor ) } , epoch )
+    return compiled_loss
+
+def compare_forward( net , forward_fn , x , num_iter = 10 , backward = True ):
+    """
+    parity and speed of forward_fn against the eager net on x , forward and backward in eval mode so neither the
+    weights nor the batch norm statistics change. returns the max abs difference of the outputs and the step times
+    """
+    training = net.training
+    net.eval()
+    def step( fn ):
+        with torch.set_grad_enabled( backward ):
+            results = fn( x )
+            if backward:
+                sum( v.float().sum() for v in results.values() ).backward()
+        return results
+    def timeit( fn ):
+        step( fn )
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        t = time.time()
+        for i in range( num_iter ):
+            step( fn )
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        return ( time.time() - t ) / num_iter
+    with torch.no_grad():
+        eager = net( x )
+        compiled = forward_fn( x )
+    diff = max( float( ( eager[k].float() - compiled[k].float() ).abs().max() ) for k in eager )
+    eager_time = timeit( net )
+    compiled_time = timeit( forward_fn )
+    net.zero_grad()
+    net.train( training )
+    return { 'max_abs_diff' : diff , 'eager_step_time' : eager_time , 'compiled_step_time' : compiled_time }
+
+def float_results( results ):
+    """
+    back to fp32 after an autocast forward , the MIL aggregation and the losses are computed in fp32
+    """
+    return { k : v.float() for k,v in results.items() }
+
+def decoupled_weight_decay( optimizer , foreach = True ):
+    """
+    param *= 1 - true_weight_decay * lr for all params of every group , the group lr and true_weight_decay already
+    include lr_mult and decay_mult ( see mannual_learning_rate ). one multi-tensor kernel per group with foreach
+    """
+    for group in optimizer.param_groups:
+        decay = group['true_weight_decay'] * group['lr']
+        if decay == 0:
+            continue
+        params = [ param.data for param in group['params'] ]
+        if foreach:
+            torch._foreach_mul_( params , 1 - decay )
+        else:
+            for param in params:
+                param.mul_( 1 - decay )
 
 def mannual_learning_rate( optimizer , epoch ,  step , num_step_epoch , config ):
     
@@ -101,77 +273,152 @@ def mannual_learning_rate( optimizer , epoch ,  step , num_step_epoch , config )
                 param_group['momentum'] = y2
 
 
-def lr_find(loss_fn,net,optimizer,dataloader,forward_fn,warp_batch_fn = None , start_lr=1e-5,end_lr = 10 , num_iter = None ,  plot_name = None ):
-
-    origin_net_state = deepcopy( net.state_dict() )
-    origin_optimizer_state = deepcopy( optimizer.state_dict() )
-    best_loss = 1e9
-    loss_list = []
-
-    if num_iter is None:
-        num_iter = len(dataloader)
-    ratio = end_lr / start_lr 
-    lr_mult = ratio ** (1/num_iter)
-    
-    lr_list = []
-    tqdm_it = tqdm( dataloader  , desc ='finding lr' , total = num_iter , file=sys.stdout , leave=False )
-    for it , x  in enumerate(tqdm_it):
-        lr = start_lr * lr_mult ** it
+class LRSchedule():
+    """
+    per step lr and momentum of the whole run , precomputed from the same settings as mannual_learning_rate :
+    lr_bounds , lrs , lr_curve ( freeze_lr_curve during the freeze_feature_layer_epochs ) and the cyclical_* params.
+    apply() only indexes the arrays , the state_dict goes into the checkpoints so a resumed run continues at the same
+    position , on the curves of its own config.
+    """
+    def __init__( self , config , num_step_epoch ):
+        self.config = config
+        self.num_step_epoch = num_step_epoch
+        self.last_step = -1
+        t = config.train
+        n = num_step_epoch
+        steps = np.arange( t['num_epochs'] * n )
+        epoch , step = steps // n , steps % n
+
+        bounds = np.array( t['lr_bounds'] )
+        idx = np.clip( np.searchsorted( bounds , epoch , side = 'right' ) - 1 , 0 , len( bounds ) - 2 )
+        length = ( bounds[idx+1] - bounds[idx] ) * n
+        #epochs outside of lr_bounds keep the value at the closest end
+        x = np.clip( ( epoch - bounds[idx] ) * n + step , 0 , length )
+        base_lr = np.array( t['lrs'] , np.float64 )[idx]
+
+        curves = {}
+        with np.errstate( divide = 'ignore' , invalid = 'ignore' ):
+            factor = t['cyclical_lr_init_factor']
+            mid_x = length * t['cyclical_lr_inc_ratio']
+            mom_min = t['cyclical_mom_min']
+            mom_max = t['cyclical_mom_max']
+            up = x <= mid_x
+            y1_up = x / mid_x * ( 1 - factor ) + factor
+            y2_up = ( mom_min - mom_max ) / mid_x * x + mom_max
+            #nan momentum : keep the configured momentum / betas
+            curves['normal'] = ( np.ones( len( steps ) ) , np.full( len( steps ) , np.nan ) )
+            curves['cosine'] = ( np.cos( np.pi / 2 / length * x ) , np.full( len( steps ) , np.nan ) )
+            curves['cyclical'] = ( np.where( up , y1_up , ( 1 - factor ) / ( mid_x - length ) * x + ( mid_x * factor - length ) / ( mid_x - length ) ),
+                                   np.where( up , y2_up , ( mom_min - mom_max ) / ( mid_x - length ) * x + ( mid_x - length * mom_min ) / ( mid_x - length ) ) )
+            curves['one_cycle'] = ( np.where( up , y1_up , ( np.cos( np.pi * ( x - mid_x ) / ( length - mid_x ) ) + 1 ) / 2 ),
+                                    np.where( up , y2_up , ( np.cos( np.pi + np.pi * ( x - mid_x ) / ( length - mid_x ) ) + 1 ) / 2 * ( mom_max - mom_min ) + mom_min ) )
+
+        freeze = epoch < t['freeze_feature_layer_epochs']
+        lr_curve , freeze_curve = curves[ t['lr_curve'] ] , curves[ t['freeze_lr_curve'] ]
+        self.lr = base_lr * np.where( freeze , freeze_curve[0] , lr_curve[0] )
+        self.momentum = np.where( freeze , freeze_curve[1] , lr_curve[1] )
+
+    def apply( self , optimizer , epoch , step ):
+        """
+        set lr , momentum ( or beta1 ) and true_weight_decay of every param group for the step of the epoch
+        """
+        config = self.config
+        self.last_step = epoch * self.num_step_epoch + step
+        lr = float( self.lr[ self.last_step ] )
+        momentum = float( self.momentum[ self.last_step ] )
         for param_group in optimizer.param_groups:
             param_group['lr'] = lr * param_group['lr_mult']
-        temp_loss_list = []
-
-        if warp_batch_fn is not None:
-            x = warp_batch_fn( x )
-        for k in x:
-            if isinstance( x[k] , torch.Tensor ):
-                x[k] = x[k].cuda()
-                x[k].requires_grad = False
-        loss_dict = loss_fn( forward_fn( x ) , x ) 
-        #stop criterion
-        loss = loss_dict['total']
-        if math.isnan( loss ) or ( it > 10 and loss > 1.5*loss_list[0] ) or it > num_iter :
-            del loss
-            del loss_dict
-            del x
-            tqdm_it.close()
-            break
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-
-
-        lr_list.append( lr )
-        loss = loss.detach().cpu().numpy()
-        loss_list.append( loss )
-
-        #update best_loss
-        if it > 10 and loss < best_loss:
-            best_loss = loss
-
-
-        
-
-
-    net.load_state_dict( origin_net_state )
-    optimizer.load_state_dict( origin_optimizer_state  )
-
+            param_group['true_weight_decay'] = config.loss['weight_l2_reg'] * param_group['decay_mult']
+            if 'betas' in param_group:
+                param_group['betas'] = ( config.train['betas'][0] if np.isnan( momentum ) else momentum , config.train['betas'][1] )
+            if 'momentum' in param_group:
+                param_group['momentum'] = config.train['momentum'] if np.isnan( momentum ) else momentum
+
+    def state_dict( self ):
+        #tensors , not numpy arrays , so that torch.load( weights_only = True ) still opens the checkpoints
+        return { 'num_step_epoch' : self.num_step_epoch , 'last_step' : self.last_step , 'lr' : torch.from_numpy( self.lr ) , 'momentum' : torch.from_numpy( self.momentum ) }
+
+    def load_state_dict( self , state_dict ):
+        """
+        restores the position in the schedule , the curves stay those of the config. a warning tells when the config
+        has changed the steps the saved schedule covered ( lrs , lr_bounds , lr_curve ... )
+        """
+        self.last_step = state_dict['last_step']
+        if state_dict['num_step_epoch'] != self.num_step_epoch:
+            warnings.warn( 'steps per epoch changed from {} to {}'.format( state_dict['num_step_epoch'] , self.num_step_epoch ) )
+            return
+        n = min( len( self.lr ) , len( state_dict['lr'] ) )
+        if not np.allclose( self.lr[:n] , np.asarray( state_dict['lr'] )[:n] ) or not np.allclose( self.momentum[:n] , np.asarray( state_dict['momentum'] )[:n] , equal_nan = True ):
+            warnings.warn( 'the lr schedule of the config differs from the saved one , following the config' )
+
+def lr_find(loss_fn,net,optimizer,dataloader,forward_fn,warp_batch_fn = None , start_lr=1e-5,end_lr = 10 , num_iter = 100 ,  plot_name = None , smooth = 0.98 , diverge = 4 , autocast = nullcontext , scaler = None ):
     '''
-    steepest_idx = np.argmin(loss_delta_list)
-    lowest_idx = np.argmin( loss_list )
-    final_lr = lr_list[int(np.floor( steepest_idx + (lowest_idx - steepest_idx) * 3/4   ))  ] 
-    tqdm.write('steepest_lr {} lowest_lr {} final_lr {}'.format(lr_list[steepest_idx] , lr_list[lowest_idx] , final_lr))
-    return final_lr
+    lr range test : lr grows exponentially from start_lr to end_lr over num_iter steps ( at most one pass of
+    dataloader ) and stops once the smoothed loss exceeds diverge times its minimum or is not finite.
+    net , optimizer ( and scaler ) are restored from cpu snapshots afterwards.
+    the loss is smoothed by a bias corrected exponential moving average of factor smooth.
+    return the suggested max lr of a one cycle schedule , the lr of the minimum of the smoothed loss divided by 10 ,
+    None if the test stopped before 10 steps
     '''
-    sm = 0.90
+    device = next( net.parameters() ).device
+    origin_net_state = to_cpu( net.state_dict() )
+    origin_optimizer_state = to_cpu( optimizer.state_dict() )
+    origin_scaler_state = scaler.state_dict() if scaler is not None else None
+
+    num_iter = min( num_iter , len( dataloader ) )
+    lr_mult = ( end_lr / start_lr ) ** ( 1 / max( num_iter - 1 , 1 ) )
+    lr_list = []
     sm_loss_list = []
-    for i in range(len(loss_list)):
-        sm_loss_list.append( np.mean( loss_list[max(i-5,0):i+1] ) )
-    d_sm_loss_list = [0] + [ sm_loss_list[i] - sm_loss_list[i-1] for i in range(1,len(sm_loss_list)) ]
-    dd_sm_loss_list = [0] + [ d_sm_loss_list[i ] - d_sm_loss_list[i-1] for i in range(1,len(d_sm_loss_list)) ]
+    avg_loss = 0
+    best_loss = float('inf')
+    tqdm_it = tqdm( dataloader  , desc ='finding lr' , total = num_iter , file=sys.stdout , leave=False )
+    try:
+        for it , x  in enumerate(tqdm_it):
+            if it >= num_iter:
+                break
+            lr = start_lr * lr_mult ** it
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr * param_group['lr_mult']
+
+            if warp_batch_fn is not None:
+                x = warp_batch_fn( x )
+            for k in x:
+                if isinstance( x[k] , torch.Tensor ):
+                    x[k] = x[k].to( device , non_blocking = True )
+                    x[k].requires_grad = False
+            with autocast():
+                results = forward_fn( x )
+            loss = loss_fn( float_results( results ) , x )['total']
+
+            #stop criterion on the smoothed loss , one read back per step
+            avg_loss = smooth * avg_loss + ( 1 - smooth ) * loss.item()
+            sm_loss = avg_loss / ( 1 - smooth ** ( it + 1 ) )
+            if not math.isfinite( sm_loss ) or sm_loss > diverge * best_loss:
+                break
+            best_loss = min( best_loss , sm_loss )
+            lr_list.append( lr )
+            sm_loss_list.append( sm_loss )
+
+            optimizer.zero_grad()
+            if scaler is not None:
+                scaler.scale( loss ).backward()
+                scaler.step( optimizer )
+                scaler.update()
+            else:
+                loss.backward()
+                optimizer.step()
+    finally:
+        tqdm_it.close()
+        optimizer.zero_grad()
+        net.load_state_dict( origin_net_state )
+        optimizer.load_state_dict( origin_optimizer_state  )
+        if scaler is not None:
+            scaler.load_state_dict( origin_scaler_state )
 
+    suggested_lr = None
+    #the first steps of the moving average are still noisy
+    if len( sm_loss_list ) > 10:
+        suggested_lr = lr_list[ 10 + int( np.argmin( sm_loss_list[10:] ) ) ] / 10
 
     plt.figure()
     f , axes = plt.subplots(1,1)
@@ -180,12 +427,30 @@ def lr_find(loss_fn,net,optimizer,dataloader,forward_fn,warp_batch_fn = None , s
     axes.set_ylabel('loss')
     axes.plot(  lr_list,sm_loss_list)
     axes.set_xscale('log')
+    if suggested_lr is not None:
+        axes.axvline( suggested_lr , color = 'r' , linestyle = '--' )
 
     if plot_name is not None:
         plt.savefig( plot_name )
+    plt.close('all')
+    return suggested_lr
 
+def scale_lrs( config , epoch , lr ):
+    '''
+    scales train['lrs'] , from the lr_bounds interval of epoch on , so that the lr of that interval is lr.
+    the ratios between the intervals are kept. None entries ( the intervals a resumed run has already done ) are left
+    as they are , the first lr that is not None is the one set to lr
+    '''
+    lrs = list( config.train['lrs'] )
+    idx = int( np.clip( np.searchsorted( config.train['lr_bounds'] , epoch , side = 'right' ) - 1 , 0 , len( lrs ) - 1 ) )
+    reference = next( ( v for v in lrs[idx:] if v is not None ) , None )
+    if reference is None:
+        warnings.warn( 'no lr to scale in {} from epoch {}'.format( lrs , epoch ) )
+        return config.train['lrs']
+    ratio = lr / reference
+    config.train['lrs'] = lrs[:idx] + [ v * ratio if v is not None else None for v in lrs[idx:] ]
+    return config.train['lrs']
 
-            
 
 
 
@@ -221,6 +486,22 @@ def lr_warmup(epoch, warmup_length):
     torch.nn.PReLU
     
 
+def latest_epoch_file( path , prefix ):
+    """
+    epoch and path of the last {prefix}{epoch}.pth of path , from the checkpoint catalog or , for directories without
+    one , a single listdir. ( None , None ) if there is none
+    """
+    catalog = Catalog( path )
+    name = catalog.latest( prefix = prefix )
+    if name is not None:
+        return catalog.data['checkpoints'][name]['epoch'] , catalog.path( name )
+    if not os.path.isdir( path ):
+        return None , None
+    epochs = [ int( m.group(1) ) for m in map( re.compile( re.escape( prefix ) + r'(\d+)\.pth$' ).match , os.listdir( path ) ) if m is not None ]
+    if len( epochs ) == 0:
+        return None , None
+    return max( epochs ) , "{}/{}{}.pth".format( path , prefix , max( epochs ) )
+
 def load_optimizer(optimizer , model , path , epoch = None ):
     """
     return the epoch
@@ -229,12 +510,11 @@ def load_optimizer(optimizer , model , path , epoch = None ):
         model = model.module
 
     if epoch is None:
-        for i in reversed( range(1000) ):
-            p = "{}/{}_epoch{}.pth".format( path,type(optimizer).__name__+'_'+type(model).__name__,i )
-            if os.path.exists( p ):
-                optimizer.load_state_dict(  torch.load( p ) )
-                print('Sucessfully resume optimizer {}'.format(p))
-                return i
+        i , p = latest_epoch_file( path , '{}_epoch'.format( type(optimizer).__name__+'_'+type(model).__name__ ) )
+        if p is not None:
+            optimizer.load_state_dict(  torch.load( p ) )
+            print('Sucessfully resume optimizer {}'.format(p))
+            return i
     else:
         p = "{}/{}_epoch{}.pth".format( path,type(optimizer).__name__+'_'+type(model).__name__,epoch )
         if os.path.exists( p ):
@@ -254,12 +534,11 @@ def load_model(model,path ,epoch = None , strict= True):
     if type(model).__name__ == name_dataparallel:
         model = model.module
     if epoch is None:
-        for i in reversed( range(1000) ):
-            p = "{}/{}_epoch{}.pth".format( path,type(model).__name__,i )
-            if os.path.exists( p ):
-                model.load_state_dict(  torch.load( p ) , strict = strict)
-                print('Sucessfully resume model {}'.format(p))
-                return i
+        i , p = latest_epoch_file( path , '{}_epoch'.format( type(model).__name__ ) )
+        if p is not None:
+            model.load_state_dict(  torch.load( p ) , strict = strict)
+            print('Sucessfully resume model {}'.format(p))
+            return i
     else:
         p = "{}/{}_epoch{}.pth".format( path,type(model).__name__,epoch )
         if os.path.exists( p ):
@@ -328,6 +607,7 @@ def save_model(model,dirname,epoch,mode = 'epoch'):
         model = model.module
     model_pathname = '{}/{}_{}{}.pth'.format(dirname,type(model).__name__,mode,epoch )
     torch.save( model.state_dict() , '{}/{}_{}{}.pth'.format(dirname,type(model).__name__,mode,epoch ) )
+    Catalog( dirname ).record( [ os.path.basename( model_pathname ) ] , epoch , content = 'model' )
 
 def del_model(model,dirname,epoch,mode = 'epoch'):
     if type(model).__name__ == name_dataparallel:
@@ -335,11 +615,14 @@ def del_model(model,dirname,epoch,mode = 'epoch'):
     model_pathname = '{}/{}_{}{}.pth'.format(dirname,type(model).__name__,mode,epoch )
     if os.path.exists( model_pathname ):
         os.system('rm {}'.format(model_pathname))
+    Catalog( dirname ).remove( os.path.basename( model_pathname ) )
 
 def save_optimizer(optimizer,model,dirname,epoch,mode='epoch'):
     if type(model).__name__ == name_dataparallel:
         model = model.module
-    torch.save( optimizer.state_dict() , '{}/{}_epoch{}.pth'.format(dirname,type(optimizer).__name__ +'_' +type(model).__name__,epoch ) )
+    optimizer_pathname = '{}/{}_epoch{}.pth'.format(dirname,type(optimizer).__name__ +'_' +type(model).__name__,epoch )
+    torch.save( optimizer.state_dict() , optimizer_pathname )
+    Catalog( dirname ).record( [ os.path.basename( optimizer_pathname ) ] , epoch , content = 'optimizer' )
 
 def del_optimizer(optimizer,model,dirname,epoch,mode='epoch'):
     if type(model).__name__ == name_dataparallel:
@@ -347,6 +630,7 @@ def del_optimizer(optimizer,model,dirname,epoch,mode='epoch'):
     model_pathname = '{}/{}_epoch{}.pth'.format(dirname,type(optimizer).__name__ +'_' +type(model).__name__,epoch )
     if os.path.exists( model_pathname ):
         os.system('rm {}'.format(model_pathname))
+    Catalog( dirname ).remove( os.path.basename( model_pathname ) )
 
 
 def make_summary(writer, key, value, step):